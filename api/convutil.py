@@ -1,23 +1,481 @@
 #!/usr/bin/env python3
 # coding: utf-8
 import adif_io
+import codecs
+import collections
+import concurrent.futures
 import csv
 import datetime
+import heapq
 import io
+import itertools
+import os
+import pickle
 import re
 import requests
+import shutil
+import struct
 import sys
+import tempfile
+import threading
+import time
 import zipfile
-
-
-def writeZIP(files):
+import zlib
+
+
+# ZIP圧縮ポリシー: 小さいメンバは無圧縮、全体サイズが大きいほど速いレベル
+ZIP_STORE_MAX = 512
+ZIP_LEVELS = ((1024 * 1024, 6), (8 * 1024 * 1024, 3))
+ZIP_LEVEL_LARGE = 1
+
+def zipLevel(total):
+    for (limit, level) in ZIP_LEVELS:
+        if total < limit:
+            return level
+    return ZIP_LEVEL_LARGE
+
+# メンバの並列圧縮: 合計がこれ以上で圧縮対象が2つ以上あればスレッドで並列に
+ZIP_PARALLEL_MIN = 256 * 1024
+ZIP_WORKERS = min(4, os.cpu_count() or 1)
+
+# ZIPの組み立て(圧縮とZIPへの書き込み)に使った時間(秒)。
+# ZipStream は変換しながら圧縮するので、logconv はこれを変換時間から分ける
+zip_stats = {'time': 0.0}
+
+def deflateMember(data, level):
+    # zipfile と同じ raw deflate (wbits=-15)。zlib は GIL を解放する
+    c = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return (c.compress(data) + c.flush(), zlib.crc32(data))
+
+def storeMember(data):
+    return (data, zlib.crc32(data))
+
+def writeZIP(files, level=None, store=(), workers=None, date_time=None):
+    # level=0 は全メンバ無圧縮、store に挙げたメンバも無圧縮
+    members = [(k, v.encode('utf-8') if isinstance(v, str) else v)
+               for (k, v) in files.items()]
+    total = sum(len(v) for (_, v) in members)
+    if level is None:
+        level = zipLevel(total)
+    if (total * 1.05 > zipfile.ZIP64_LIMIT or
+        len(members) >= zipfile.ZIP_FILECOUNT_LIMIT):
+        return writeZIP64(members, level, store)
+
+    start = time.perf_counter()
+
+    stored = [level == 0 or k in store or len(v) <= ZIP_STORE_MAX
+              for (k, v) in members]
+    if workers is None:
+        workers = ZIP_WORKERS
+    ndeflate = stored.count(False)
+    if workers > 1 and ndeflate > 1 and total >= ZIP_PARALLEL_MIN:
+        with concurrent.futures.ThreadPoolExecutor(min(workers, ndeflate)) as ex:
+            jobs = [ex.submit(storeMember, v) if st else
+                    ex.submit(deflateMember, v, level)
+                    for ((_, v), st) in zip(members, stored)]
+            packed = [j.result() for j in jobs]
+    else:
+        packed = [storeMember(v) if st else deflateMember(v, level)
+                  for ((_, v), st) in zip(members, stored)]
+    zip_stats['time'] += time.perf_counter() - start
+
+    # 入力順に並べて zipfile と同じバイト列を組み立てる
+    z = ZipStream(io.BytesIO(), level, date_time=date_time)
+    for ((k, v), st, (data, crc)) in zip(members, stored, packed):
+        z.addRaw(k, data, crc, len(v), st)
+    return z.getvalue()
+
+def writeZIP64(members, level, store):
+    # ZIP64 が必要な大きさなら zipfile に任せる
+    start = time.perf_counter()
     buff = io.BytesIO()
     with zipfile.ZipFile(buff, 'w', zipfile.ZIP_DEFLATED) as z:
-        for k, v in files.items():
-            z.writestr(k, v)
-        z.close()
+        for (k, v) in members:
+            if level == 0 or k in store or len(v) <= ZIP_STORE_MAX:
+                z.writestr(k, v, compress_type=zipfile.ZIP_STORED)
+            else:
+                z.writestr(k, v, compresslevel=level)
+    zip_stats['time'] += time.perf_counter() - start
     return buff.getvalue()
 
+# ストリーミング変換: 出力ファイルを書き終えたものから順にZIPへ書き出す
+ZIP_SPOOL_MAX = 8 * 1024 * 1024
+ZIP_CHUNK = 64 * 1024
+
+class ZipStream:
+    # dict と同じく files[name] = data / update() で追加できるZIP出力先。
+    # 追加したメンバはすぐ圧縮して fp に書き、内容はメモリに残さない
+    def __init__(self, fp=None, level=6, store=(), date_time=None):
+        if fp is None:
+            fp = tempfile.SpooledTemporaryFile(max_size=ZIP_SPOOL_MAX)
+        if date_time is None:
+            date_time = time.localtime(time.time())[:6]
+        self.fp = fp
+        self.level = level
+        self.store = store
+        self.date_time = date_time
+        self.infos = []
+        self.names = set()
+        self.truncated = None
+
+    def memberName(self, name):
+        # 同名のメンバは上書きできないので番号を付ける
+        if name in self.names:
+            (base, ext) = os.path.splitext(name)
+            n = 2
+            while f"{base}-{n}{ext}" in self.names:
+                n += 1
+            name = f"{base}-{n}{ext}"
+        self.names.add(name)
+        return name
+
+    def addRaw(self, name, data, crc, size, stored):
+        # data は圧縮済みのバイト列、またはそれを読み出せるファイル
+        start = time.perf_counter()
+        if isinstance(data, (bytes, bytearray)):
+            csize = len(data)
+        else:
+            csize = data.seek(0, io.SEEK_END)
+            data.seek(0)
+        zinfo = zipfile.ZipInfo(self.memberName(name), self.date_time)
+        zinfo.compress_type = zipfile.ZIP_STORED if stored else zipfile.ZIP_DEFLATED
+        zinfo.external_attr = 0o600 << 16
+        zinfo.file_size = size
+        zinfo.compress_size = csize
+        zinfo.CRC = crc
+        zinfo.header_offset = self.fp.tell()
+        if max(size, csize, zinfo.header_offset) > zipfile.ZIP64_LIMIT:
+            raise zipfile.LargeZipFile("ZIP output exceeds 4GB")
+        self.fp.write(zinfo.FileHeader(False))
+        if isinstance(data, (bytes, bytearray)):
+            self.fp.write(data)
+        else:
+            shutil.copyfileobj(data, self.fp, ZIP_CHUNK)
+        self.infos.append(zinfo)
+        zip_stats['time'] += time.perf_counter() - start
+
+    def __setitem__(self, name, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        stored = self.level == 0 or name in self.store or len(data) <= ZIP_STORE_MAX
+        start = time.perf_counter()
+        if stored:
+            (packed, crc) = storeMember(data)
+        else:
+            (packed, crc) = deflateMember(data, self.level)
+        zip_stats['time'] += time.perf_counter() - start
+        self.addRaw(name, packed, crc, len(data), stored)
+
+    def __contains__(self, name):
+        return name in self.names
+
+    def update(self, files):
+        for (k, v) in files.items():
+            self[k] = v
+
+    def open(self, name, encoding='utf-8', errors='strict'):
+        return ZipMemberWriter(self, name, encoding, errors)
+
+    def close(self):
+        # セントラルディレクトリを書いて先頭に戻した fp を返す
+        start = time.perf_counter()
+        start_dir = self.fp.tell()
+        for zinfo in self.infos:
+            dt = zinfo.date_time
+            dosdate = (dt[0] - 1980) << 9 | dt[1] << 5 | dt[2]
+            dostime = dt[3] << 11 | dt[4] << 5 | (dt[5] // 2)
+            try:
+                fname = zinfo.filename.encode('ascii')
+                flag_bits = zinfo.flag_bits
+            except UnicodeEncodeError:
+                fname = zinfo.filename.encode('utf-8')
+                flag_bits = zinfo.flag_bits | 0x800
+            self.fp.write(struct.pack(
+                zipfile.structCentralDir, zipfile.stringCentralDir,
+                zinfo.create_version, zinfo.create_system,
+                zinfo.extract_version, zinfo.reserved, flag_bits,
+                zinfo.compress_type, dostime, dosdate, zinfo.CRC,
+                zinfo.compress_size, zinfo.file_size, len(fname),
+                len(zinfo.extra), len(zinfo.comment), 0,
+                zinfo.internal_attr, zinfo.external_attr, zinfo.header_offset))
+            self.fp.write(fname)
+            self.fp.write(zinfo.extra)
+            self.fp.write(zinfo.comment)
+        end_dir = self.fp.tell()
+        if len(self.infos) >= zipfile.ZIP_FILECOUNT_LIMIT:
+            raise zipfile.LargeZipFile("Too many files in ZIP output")
+        self.fp.write(struct.pack(
+            zipfile.structEndArchive, zipfile.stringEndArchive, 0, 0,
+            len(self.infos), len(self.infos), end_dir - start_dir, start_dir, 0))
+        self.fp.seek(0)
+        zip_stats['time'] += time.perf_counter() - start
+        return self.fp
+
+    def getvalue(self):
+        return self.close().read()
+
+class ZipMemberWriter:
+    # 1メンバ分のテキストを逐次圧縮して一時ファイルにためる。
+    # 複数のメンバを同時に書ける。close() でZIPに追加する
+    def __init__(self, zs, name, encoding, errors):
+        self.zs = zs
+        self.name = name
+        self.encoder = codecs.getincrementalencoder(encoding)(errors)
+        self.stored = zs.level == 0 or name in zs.store
+        self.compressor = (None if self.stored else
+                           zlib.compressobj(zs.level, zlib.DEFLATED, -15))
+        self.spool = tempfile.SpooledTemporaryFile(max_size=ZIP_CHUNK * 4)
+        self.pending = []
+        self.npending = 0
+        self.size = 0
+        self.crc = 0
+        self.closed = False
+
+    def write(self, s):
+        self.pending.append(s)
+        self.npending += len(s)
+        if self.npending >= ZIP_CHUNK:
+            self.deflate(False)
+        return len(s)
+
+    def deflate(self, final):
+        data = self.encoder.encode(''.join(self.pending), final)
+        self.pending = []
+        self.npending = 0
+        start = time.perf_counter()
+        self.size += len(data)
+        self.crc = zlib.crc32(data, self.crc)
+        self.spool.write(data if self.stored else self.compressor.compress(data))
+        if final and not self.stored:
+            self.spool.write(self.compressor.flush())
+        zip_stats['time'] += time.perf_counter() - start
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.deflate(True)
+        self.zs.addRaw(self.name, self.spool, self.crc, self.size, self.stored)
+        self.spool.close()
+
+    def discard(self):
+        # ZIPに追加せずに捨てる
+        self.closed = True
+        self.spool.close()
+
+class MemoryOutput(io.StringIO):
+    # ZipStream.open と同じ使い方で、close() したとき files[name] に格納する
+    def __init__(self, files, name, encoding=None, errors='strict'):
+        super().__init__()
+        self.files = files
+        self.name = name
+        self.encoding_out = encoding
+        self.errors_out = errors
+
+    def close(self):
+        if not self.closed and self.files is not None:
+            value = self.getvalue()
+            if self.encoding_out:
+                value = value.encode(self.encoding_out, self.errors_out)
+            self.files[self.name] = value
+        super().close()
+
+    def discard(self):
+        self.files = None
+        super().close()
+
+def isStream(files):
+    return isinstance(files, ZipStream)
+
+def openOutput(files, name, encoding=None, errors='strict'):
+    # 出力先が ZipStream なら逐次圧縮、dict なら close 時にまとめて格納
+    if isStream(files):
+        return files.open(name, encoding or 'utf-8', errors)
+    return MemoryOutput(files, name, encoding, errors)
+
+# PartitionedCSV がメモリにためる文字数。超えたら一時ファイルに書き出す
+PARTITION_BUFFER_MAX = 4 * 1024 * 1024
+
+class PartitionedCSV:
+    # 出力ファイル名ごとに行を分けて書く。
+    # 入力が日付順に並んでいなくても1回の走査で日付ごとに分けられる。
+    # 各ファイルはCSVテキストのままためておき(合計が PARTITION_BUFFER_MAX を
+    # 超えたら共有の一時ファイルへ)、close() で1ファイルずつ出力する。
+    # 圧縮器はファイル数によらず同時に1つしか使わない
+    def __init__(self, files, **fmtparams):
+        self.files = files
+        self.writer = csv.writer(self, **fmtparams)
+        self.parts = {}
+        self.current = None
+        self.npending = 0
+        self.spill = None
+
+    def write(self, s):
+        # csv.writer の出力先
+        self.current.append(s)
+        self.npending += len(s)
+
+    def writerow(self, name, row):
+        part = self.parts.get(name)
+        if part is None:
+            # (メモリ上の行, 一時ファイル上の (位置, 長さ))
+            part = self.parts[name] = ([], [])
+        self.current = part[0]
+        self.writer.writerow(row)
+        if self.npending >= PARTITION_BUFFER_MAX:
+            self.flush()
+
+    def flush(self):
+        if self.spill is None:
+            self.spill = tempfile.TemporaryFile()
+        for (pending, chunks) in self.parts.values():
+            if pending:
+                data = ''.join(pending).encode('utf-8')
+                chunks.append((self.spill.tell(), len(data)))
+                self.spill.write(data)
+                pending.clear()
+        self.npending = 0
+
+    def close(self):
+        # 最初に書いた順に出力する
+        for (name, (pending, chunks)) in self.parts.items():
+            out = openOutput(self.files, name)
+            for (pos, size) in chunks:
+                self.spill.seek(pos)
+                out.write(self.spill.read(size).decode('utf-8'))
+            out.write(''.join(pending))
+            out.close()
+        if self.spill is not None:
+            self.spill.close()
+            self.spill = None
+        self.parts = {}
+        self.npending = 0
+
+# 時刻順に並べ替えるときに一度にメモリに置く件数。
+# これを超えたらソート済みの塊を一時ファイルに書き出してマージする
+SORT_RUN = 20000
+
+def externalSort(items, key, run=None):
+    run = run or SORT_RUN
+    runs = []
+    buff = []
+    try:
+        for (seq, item) in enumerate(items):
+            # seq で同じ時刻の順序を保つ。item 同士は比較しない
+            buff.append((key(item), seq, item))
+            if len(buff) >= run:
+                runs.append(spillRun(buff))
+                buff = []
+        buff.sort()
+        for (_, _, item) in heapq.merge(*[readRun(f) for f in runs], buff):
+            yield item
+    finally:
+        for f in runs:
+            f.close()
+
+def spillRun(buff):
+    buff.sort()
+    f = tempfile.TemporaryFile()
+    for x in buff:
+        pickle.dump(x, f, pickle.HIGHEST_PROTOCOL)
+    f.seek(0)
+    return f
+
+def readRun(f):
+    while True:
+        try:
+            yield pickle.load(f)
+        except EOFError:
+            return
+
+def qsoKey(decoder, row):
+    # 時刻順のキー。日時の読めない行は最後に
+    try:
+        h = decoder(row)
+    except Exception:
+        return (2,)
+    if h.get('date_error') or h.get('time_error') or 'year' not in h:
+        return (2,)
+    return (1, h['year'], h['month'], h['day'], h['hour'], h['minute'])
+
+# 入力行数の上限。dict に出力するときはメモリ保護のため制限する。
+# ZipStream に出力するときは STREAM_MAX_LINES (None なら無制限)
+MAX_LINES = 100000
+STREAM_MAX_LINES = None
+TRUNCATED_NAME = 'TRUNCATED.txt'
+
+def lineLimit(files):
+    return STREAM_MAX_LINES if isStream(files) else MAX_LINES
+
+def overLimit(linecount, limit):
+    return limit is not None and linecount > limit
+
+def reportTruncated(files, limit):
+    # 打ち切ったことを出力に明示する
+    msg = (f"Input exceeded {limit} lines. The rest was not converted.\n"
+           f"入力が{limit}行を超えたため、以降の行は変換していません。\n")
+    if isStream(files):
+        files.truncated = limit
+    files[TRUNCATED_NAME] = msg
+    return msg
+
+class LRUCache:
+    def __init__(self, maxsize=64, maxbytes=16 * 1024 * 1024):
+        self.entries = collections.OrderedDict()
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        e = self.entries.get(key)
+        if e is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return e[0]
+
+    def put(self, key, value, size=None):
+        if size is None:
+            size = cacheSize(value)
+        if size > self.maxbytes:
+            return
+        old = self.entries.pop(key, None)
+        if old:
+            self.nbytes -= old[1]
+        self.entries[key] = (value, size)
+        self.nbytes += size
+        while len(self.entries) > self.maxsize or self.nbytes > self.maxbytes:
+            (_, (_, s)) = self.entries.popitem(last=False)
+            self.nbytes -= s
+            self.evictions += 1
+
+    def clear(self):
+        self.entries.clear()
+        self.nbytes = 0
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': len(self.entries),
+            'bytes': self.nbytes,
+        }
+
+def cacheSize(obj):
+    # 文字列長ベースの概算サイズ
+    if isinstance(obj, (str, bytes)):
+        return len(obj)
+    if isinstance(obj, dict):
+        return sum(cacheSize(v) for v in obj.values()) + 8 * len(obj)
+    if isinstance(obj, (list, tuple)):
+        return sum(cacheSize(v) for v in obj) + 8 * len(obj)
+    return 8
+
 def emitError(txt):
     print("Content-Type:text/html\n\n")
     print("<h4><font color=\"#ff0000\"> Error: {}</font></h4>".format(txt))
@@ -133,10 +591,26 @@ adif_mode_table = [
     ('DIGITALVOICE',['C4FM','DMR','DSTAR','FREEDV','M17',])
 ]
 
+def patternMap(table):
+    # [(値, [パターン,...]),...] を {パターン: 値} に。先に書いたものを優先
+    m = {}
+    for (v, pat) in table:
+        for p in pat:
+            m.setdefault(p, v)
+    return m
+
+sota_mode_map = patternMap(sota_mode_table)
+adif_normalize_map = patternMap(adif_normalize)
+adif_mode_map = patternMap(adif_mode_table)
+
     
 def errMsg(val):
     return ('<font color="red"><b>' + str(val) + '</b></font>')
     
+# ADIF の BAND から AirHam/SOTA のバンド表記を引く
+wlen_to_band = {wlen.upper(): (band_air, band_sota)
+                for (_, _, band_air, band_sota, wlen) in freq_table}
+
 def band_to_freq(band_str, is_sota = False):
     for (_, _, f_air, f_sota, b) in freq_table:
         b1 = b.upper()
@@ -148,8 +622,11 @@ def band_to_freq(band_str, is_sota = False):
                 return f_air
     return(None)
     
+freq_slash_pat = re.compile(r'([\d\.]+)/[\d\.]+')
+
 def freq_to_band(freq_str):
-    freq_str = re.sub(r'([\d\.]+)/[\d\.]+',r'\1',freq_str)
+    if '/' in freq_str:
+        freq_str = freq_slash_pat.sub(r'\1',freq_str)
     try:
         freq = float(freq_str)
     except Exception as e:
@@ -178,188 +655,176 @@ def mode_to_airhammode(mode,freq_str):
         return m
 
 def mode_to_SOTAmode(mode):
-    for smode,pat in sota_mode_table:
-        if mode.upper() in pat:
-            return smode
-    return 'OTHER'
+    return sota_mode_map.get(mode.upper(), 'OTHER')
 
 def mode_to_ADIFmode(smode):
     smode = smode.upper()
-    for mode,pat in adif_normalize:
-        if smode in pat:
-            smode = mode
-            break
-    for mode,pat in adif_mode_table:
-        if smode in pat:
-            return (mode, smode)
+    smode = adif_normalize_map.get(smode, smode)
+    mode = adif_mode_map.get(smode)
+    if mode:
+        return (mode, smode)
     return (smode, '')
 
+call_pat = re.compile(r'(\w+)/(\w+)(?:/(\w+))?')
+
 def splitCallsign(call):
     call = call.upper()
-    m = re.match(r'(\w+)/(\w+)/(\w+)',call)
+    m = call_pat.match(call)
     if m:
-        m2 = re.match(r'\d+',m.group(2))
-        if m2:
-            operator = m.group(1)
-            portable = m.group(2)+'/'+m.group(3)
-        else:
-            operator = m.group(2)
-            portable = m.group(1)
-    else:
-        m = re.match(r'(\w+)/(\w+)',call)
-        if m:
-            m2 = re.match(r'\d+',m.group(2))
-            if m2:
-                operator = m.group(1)
-                portable = m.group(2)
-            elif m.group(2).upper() == "QRP":
-                operator = m.group(1)
-                portable = m.group(2)
-            elif len(m.group(2))>len(m.group(1)):
-                operator = m.group(2)
-                portable = m.group(1)
+        (g1, g2, g3) = m.groups()
+        if g3:
+            if g2[0].isdecimal():
+                operator = g1
+                portable = g2+'/'+g3
             else:
-                operator = m.group(1)
-                portable = m.group(2)
+                operator = g2
+                portable = g1
+        elif g2[0].isdecimal():
+            operator = g1
+            portable = g2
+        elif g2 == "QRP":
+            operator = g1
+            portable = g2
+        elif len(g2)>len(g1):
+            operator = g2
+            portable = g1
         else:
-            operator = call.strip()
-            portable = ''
+            operator = g1
+            portable = g2
+    else:
+        operator = call.strip()
+        portable = ''
             
     return (operator, portable)
 
 
-def decodeHamlog(cols):
+hamlog_date_pat = re.compile(r'(\d+)/(\d+)/(\d+)')
+hamlog_time_pat = re.compile(r'(\d\d):(\d\d)(\w)')
+tz_utc = datetime.timezone.utc
+tz_jst = datetime.timezone(datetime.timedelta(hours=9))
+hamlog_nodate = datetime.datetime(1900, 1, 1, tzinfo=tz_utc)
 
+def decodeHamlog(cols):
+    # 行ごとに呼ばれるので、成功時はエラー文字列を作らない
     errorfl = False
-    errormsg = []
+    errormsg = None
+    errordate = ''
+    errortime = ''
     
     if len(cols) < 15:
         raise ValueError("エラー:HAMLOG CSV形式ではありません")
-    else:
-        (operator, portable) = splitCallsign(cols[0])
+
+    (operator, portable) = splitCallsign(cols[0])
         
-        m = re.match(r'(\d+)/(\d+)/(\d+)',cols[1])
-        if m:
-            if len(m.group(1)) > 2:
-                year = m.group(1)
+    m = hamlog_date_pat.match(cols[1])
+    if m:
+        (year, month, day) = m.groups()
+        if len(year) <= 2:
+            if int(year) >= 65:
+                year = '19' + year
             else:
-                if int(m.group(1)) >= 65:
-                    year = '19' + m.group(1)
-                else:
-                    year = '20' + m.group(1)
-            month = m.group(2)
-            day = m.group(3)
-            errordate = ''
-        else:
-            errorfl = True
-            errormsg.append("日付フォーマット不正:{}".format(cols[1]))
-            year = '1900'
-            month = '01'
-            day = '01'
-            errordate = errMsg(cols[1])
+                year = '20' + year
+    else:
+        errorfl = True
+        errormsg = ["日付フォーマット不正:{}".format(cols[1])]
+        (year, month, day) = ('1900', '01', '01')
+        errordate = errMsg(cols[1])
             
-        m = re.match(r'(\d\d):(\d\d)(\w)',cols[2])
-        if m:
-            hour = m.group(1)
-            minute = m.group(2)
-            fl = m.group(3).upper()
-            if fl == 'U' or fl == 'Z':
-                timezone = '+0000'
-            else:
-                timezone = '+0900'
-            errortime = ''
+    m = hamlog_time_pat.match(cols[2])
+    if m:
+        (hour, minute, fl) = m.groups()
+        if fl in 'UuZz':
+            (timezone, tz) = ('+0000', tz_utc)
         else:
-            errorfl = True
-            errormsg.append("時刻フォーマット不正:{}".format(cols[2]))
-            hour = '00'
-            minute = '00'
-            timezone = '+0900'
-            errortime = errMsg(cols[2])
+            (timezone, tz) = ('+0900', tz_jst)
+    else:
+        errorfl = True
+        errormsg = (errormsg or []) + ["時刻フォーマット不正:{}".format(cols[2])]
+        (hour, minute) = ('00', '00')
+        (timezone, tz) = ('+0900', tz_jst)
+        errortime = errMsg(cols[2])
 
+    # 桁数は strptime('%Y/%m/%d %H:%M %z') と同じ制限。
+    # 全角などの Unicode 数字は int() がそのまま読めるので受け付ける
+    try:
+        if len(year) != 4 or len(month) > 2 or len(day) > 2:
+            raise ValueError(year)
+        atime = datetime.datetime(int(year), int(month), int(day),
+                                  int(hour), int(minute), tzinfo=tz)
+        utime = atime.astimezone(tz_utc)
+        isotime = atime.isoformat()
+    except (ValueError, OverflowError):
+        errorfl = True
         tstr = year + '/' + month + '/' + day + ' ' + hour + ':' + minute + ' ' + timezone
-        try:
-            atime = datetime.datetime.strptime(tstr,'%Y/%m/%d %H:%M %z')
-            utime = atime.astimezone(datetime.timezone(datetime.timedelta(hours=0)))
-            isotime = atime.isoformat()
-        except Exception as e:
-            errorfl = True
-            errormsg.append("時刻フォーマット不正:{}".format(operator+ ":"+tstr))
-            atime = datetime.datetime.strptime("1900/1/1 0:0 +0000",'%Y/%m/%d %H:%M %z')
-            utime = atime.astimezone(datetime.timezone(datetime.timedelta(hours=0)))
-            isotime = atime.isoformat()
-            [errordate ,errortime] = map(errMsg,[cols[1],cols[2]])
+        errormsg = (errormsg or []) + ["時刻フォーマット不正:{}".format(operator+ ":"+tstr)]
+        utime = hamlog_nodate
+        isotime = utime.isoformat()
+        [errordate ,errortime] = map(errMsg,[cols[1],cols[2]])
         
-        year = utime.year
-        month = utime.month
-        day = utime.day
-        hour = utime.hour
-        minute = utime.minute
-
-        try:
-            (band_air,band_sota,wlen) = freq_to_band(cols[5])
-            band_error = ''
-        except Exception as e:
-            errorfl = True
-            band_error = errMsg(str(e))
-            errormsg.append("周波数不正:{}".format(e))
-            (band_air,band_sota,wlen) = (band_error, band_error, band_error)
+    freq = cols[5]
+    try:
+        (band_air,band_sota,wlen) = freq_to_band(freq)
+        band_error = ''
+    except Exception as e:
+        errorfl = True
+        band_error = errMsg(str(e))
+        errormsg = (errormsg or []) + ["周波数不正:{}".format(e)]
+        (band_air,band_sota,wlen) = (band_error, band_error, band_error)
             
-        qsl_sent = 0
-        qsl_rcvd = 0
-        qsl_via = ""
-        qslflag = cols[9].upper() +'   '
-        qslflag = qslflag[:3]
+    qsl_sent = 0
+    qsl_rcvd = 0
+    qslflag = (cols[9].upper() +'   ')[:3]
         
-        if len(qslflag) == 3:
-            if qslflag[0] == 'N':
-                qsl_via = 'No Card'
-            elif qslflag[0] == 'J':
-                qsl_via = 'JARL (Bureau)'
-            else:
-                qsl_via = qslflag
-
-            if qslflag[1] != ' ':
-                qsl_sent = 1
-            if qslflag[2] != ' ':
-                qsl_rcvd = 1
-        (mode, smode) = mode_to_ADIFmode(cols[6])
-        return {
-            'error':errorfl,
-            'errormsg':"エラー:" + ",".join(errormsg),
-            'date_error':errordate,
-            'time_error':errortime,
-            'band_error':band_error,
+    if qslflag[0] == 'N':
+        qsl_via = 'No Card'
+    elif qslflag[0] == 'J':
+        qsl_via = 'JARL (Bureau)'
+    else:
+        qsl_via = qslflag
+    if qslflag[1] != ' ':
+        qsl_sent = 1
+    if qslflag[2] != ' ':
+        qsl_rcvd = 1
+
+    smode = cols[6]
+    (mode, sub_mode) = mode_to_ADIFmode(smode)
+    return {
+        'error':errorfl,
+        'errormsg':"エラー:" + ",".join(errormsg) if errormsg else "エラー:",
+        'date_error':errordate,
+        'time_error':errortime,
+        'band_error':band_error,
             
-            'callsign': cols[0],   # All
-            'operator': operator,  # AirHam
-            'portable': portable,  # AirHam
-            'isotime': isotime,    # AirHam
-            'year': year,          # SOTA,WWFF
-            'month': month,        # SOTA,WWFF
-            'day': day,            # SOTA,WWFF
-            'hour': hour,          # SOTA,WWFF
-            'minute': minute,      # SOTA,WWFF
-            'timezone': timezone,  # AirHam
-            'rst_sent': cols[3],   # All
-            'rst_rcvd': cols[4],   # All
-            'freq': cols[5],       # None
-            'band': band_air,      # AirHam
-            'band-sota': band_sota,# SOTA
-            'band-wlen': wlen,     # WWFF
-            'mode': mode,       # WWFF
-            'sub_mode': smode,
-            'mode-airham': mode_to_airhammode(cols[6],cols[5]), #AirHam
-            'mode-sota': mode_to_SOTAmode(cols[6]), #SOTA
-            'code': cols[7],   # None
-            'gl': cols[8],     # SOTA
-            'qsl': qsl_via,    # AirHam
-            'qsl_sent':qsl_sent, #AirHam
-            'qsl_rcvd':qsl_rcvd, #AirHam
-            'name': cols[10],  # None
-            'qth': cols[11],   # SOTA
-            'rmks1': cols[12], # All
-            'rmks2': cols[13]  # All
-        }
+        'callsign': cols[0],   # All
+        'operator': operator,  # AirHam
+        'portable': portable,  # AirHam
+        'isotime': isotime,    # AirHam
+        'year': utime.year,    # SOTA,WWFF
+        'month': utime.month,  # SOTA,WWFF
+        'day': utime.day,      # SOTA,WWFF
+        'hour': utime.hour,    # SOTA,WWFF
+        'minute': utime.minute,# SOTA,WWFF
+        'timezone': timezone,  # AirHam
+        'rst_sent': cols[3],   # All
+        'rst_rcvd': cols[4],   # All
+        'freq': freq,          # None
+        'band': band_air,      # AirHam
+        'band-sota': band_sota,# SOTA
+        'band-wlen': wlen,     # WWFF
+        'mode': mode,       # WWFF
+        'sub_mode': sub_mode,
+        'mode-airham': mode_to_airhammode(smode,freq), #AirHam
+        'mode-sota': mode_to_SOTAmode(smode), #SOTA
+        'code': cols[7],   # None
+        'gl': cols[8],     # SOTA
+        'qsl': qsl_via,    # AirHam
+        'qsl_sent':qsl_sent, #AirHam
+        'qsl_rcvd':qsl_rcvd, #AirHam
+        'name': cols[10],  # None
+        'qth': cols[11],   # SOTA
+        'rmks1': cols[12], # All
+        'rmks2': cols[13]  # All
+    }
 
 def decodeADIF(cols):
     qsos , header = adif_io.read_from_string(cols)
@@ -372,17 +837,21 @@ def decodeADIF(cols):
     errorfl = False
     errormsg = ''
 
+    freq = qso.get('FREQ', '')
     if 'FREQ' in qso.keys():
         try:
-            (_, _ ,wlen) = freq_to_band(qso['FREQ'])
+            (band_air, band_sota, wlen) = freq_to_band(qso['FREQ'])
         except Exception as e:
             errorfl = True
             wlen  = errMsg(str(e))
             errormsg = "周波数不正:{}".format(e)
+            (band_air, band_sota) = (wlen, wlen)
     elif 'BAND' in qso.keys():
         wlen = qso['BAND']
+        (band_air, band_sota) = wlen_to_band.get(wlen.upper(), ('', ''))
     else:
         wlen = ''
+        (band_air, band_sota) = ('', '')
         
     if 'MY_SIG_INFO' in qso:
         my_sig = qso['MY_SIG_INFO']
@@ -399,6 +868,15 @@ def decodeADIF(cols):
         his_sig = ''
 
     (mode, smode) = mode_to_ADIFmode(qso['MODE'])
+    (operator, portable) = splitCallsign(qso['CALL'])
+    (year, month, day) = (int(qso['QSO_DATE'][0:4]), int(qso['QSO_DATE'][4:6]),
+                          int(qso['QSO_DATE'][6:8]))
+    (hour, minute) = (int(qso['TIME_ON'][0:2]), int(qso['TIME_ON'][2:4]))
+    try:
+        isotime = datetime.datetime(year, month, day, hour, minute,
+                                    tzinfo=datetime.timezone.utc).isoformat()
+    except ValueError:
+        isotime = ''
     log = {
         'error':errorfl,
         'errormsg':errormsg,
@@ -407,14 +885,29 @@ def decodeADIF(cols):
         'band_error':'',
         
         'callsign': qso['CALL'] ,# All
-        'year': int(qso['QSO_DATE'][0:4]),# SOTA,WWFF
-        'month':int(qso['QSO_DATE'][4:6]),        # SOTA,WWFF
-        'day': int(qso['QSO_DATE'][6:8]),            # SOTA,WWFF
-        'hour': int(qso['TIME_ON'][0:2]),          # SOTA,WWFF
-        'minute': int(qso['TIME_ON'][2:4]),      # SOTA,WWFF
+        'operator': operator,  # AirHam
+        'portable': portable,  # AirHam
+        'isotime': isotime,    # AirHam
+        'year': year,          # SOTA,WWFF
+        'month': month,        # SOTA,WWFF
+        'day': day,            # SOTA,WWFF
+        'hour': hour,          # SOTA,WWFF
+        'minute': minute,      # SOTA,WWFF
+        'timezone': '+0000',   # AirHam
+        'freq': freq,          # None
+        'band': band_air,      # AirHam
+        'band-sota': band_sota,# SOTA
         'band-wlen': wlen,     # WWFF
         'mode': mode ,# WWFF
         'sub_mode': smode,
+        'mode-airham': mode_to_airhammode(qso['MODE'], freq), #AirHam
+        'mode-sota': mode_to_SOTAmode(qso['MODE']), #SOTA
+        'code': '',
+        'gl': qso.get('GRIDSQUARE', ''),
+        'qsl': '',
+        'qsl_sent': int(qso.get('QSL_SENT', '').upper() == 'Y'),
+        'qsl_rcvd': int(qso.get('QSL_RCVD', '').upper() == 'Y'),
+        'name': qso.get('NAME', ''),
         'qth': his_sig,
         'rmks1': '',
         'rmks2': ''
@@ -571,54 +1064,69 @@ def toAirHam(decoder, lcount, row, options):
         ]
     return l
 
+# get_ref が見るのは先頭の REF_FIELD_MAX 文字まで
+REF_FIELD_MAX = 1024
+
+# どのパターンも英数字などの並びの先頭からしか照合を始めないので、
+# 入力長に比例する時間で済む(.*? で全位置から試すと長い数字列などで2乗以上になる)
+ref_loc_pat = re.compile(r'(?:(?=-)|(?<!\d))(-?\d+(\.\d+)?[nsNS]?\s*,\s*\-?\d+(\.\d+)?[ewEW]?)')
+ref_split_pat = re.compile(r'[,\s]')
+ref_wwff_pat = re.compile(r'(?<![A-Z0-9])[A-Z0-9]+FF-\d+', re.IGNORECASE)
+ref_pota_pat = re.compile(r'(?<![a-zA-Z0-9])[a-zA-Z0-9]+-\d\d\d\d')
+ref_sota_pat = re.compile(r'(?<![a-zA-Z0-9])([a-zA-Z0-9]+/[a-zA-Z0-9]+)-\d+')
+ref_qra_pat = re.compile(r'[a-zA-Z]{2}\d{2}[a-zA-Z]{2}')
+ref_sat_pat = re.compile(r'(?<![a-zA-Z])([a-zA-Z]+-\d+)/([a-zA-Z]+/(\w+))')
+
 def get_ref(str):
     r = {'SOTA':'', 'PORT':'', 'WWFF':[] ,'POTA':[],
          'LOC':'', 'LOC_org':'',
          'SAT':'','SAT_oscar':'','SAT_org':'','SAT_down':'',
          'ORG':'' }
-    m = re.match(r'.*?(-?\d+(\.\d+)?[nsNS]?\s*,\s*\-?\d+(\.\d+)?[ewEW]?).*',
-                 str)
-    if m:
+    str = str[:REF_FIELD_MAX]
+    m = ref_loc_pat.search(str)
+    # 緯度経度は1行目から始まるものだけ
+    if m and '\n' not in str[:m.start()]:
         r['LOC'] = '%QTH%' + m.group(1) + '% '
  
-    l = re.split(r'[,\s]', str)
+    org = []
+    l = ref_split_pat.split(str)
     for ref in l:
-        m = re.match(r'.*?([A-Z0-9]+FF-\d+).*', ref, re.IGNORECASE)
+        m = ref_wwff_pat.search(ref)
         if m:
-            r['WWFF'].append(m.group(1).upper())
+            r['WWFF'].append(m.group().upper())
             continue
 
-        m = re.match(r'.*?([a-zA-Z0-9]+-\d\d\d\d).*',ref)
+        m = ref_pota_pat.search(ref)
         if m:
-            r['POTA'].append(m.group(1).upper())
+            r['POTA'].append(m.group().upper())
             continue
 
-        m = re.match(r'.*?(([a-zA-Z0-9]+/[a-zA-Z0-9]+)-\d+).*',ref)
+        m = ref_sota_pat.search(ref)
         if m:
-            r['SOTA'] = m.group(1).upper()
-            p = m.group(2).upper()
+            r['SOTA'] = m.group().upper()
+            p = m.group(1).upper()
             if p in JA_region_table:
                 r['PORT'] = JA_region_table[p]
             else:
                 r['PORT'] = 'P'
             continue
 
-        m = re.match(r'.*?([a-zA-Z]{2}\d{2}[a-zA-Z]{2}).*',ref)
+        m = ref_qra_pat.search(ref)
         if m:
-            r['LOC'] = '%QRA%' + m.group(1) + '% '
-            r['LOC_org'] = m.group(1)
+            r['LOC'] = '%QRA%' + m.group() + '% '
+            r['LOC_org'] = m.group()
             continue
         
-        m = re.match(r'.*?(([a-zA-Z]+-\d+)/([a-zA-Z]+/(\w+))).*',ref)
+        m = ref_sat_pat.search(ref)
         if m:
-            r['SAT'] = '%SAT%' + m.group(2).upper() + '%,'+ m.group(3)
-            r['SAT_oscar'] = m.group(2).upper()
-            r['SAT_org'] = m.group(1)
-            r['SAT_down'] = m.group(4)
+            r['SAT'] = '%SAT%' + m.group(1).upper() + '%,'+ m.group(2)
+            r['SAT_oscar'] = m.group(1).upper()
+            r['SAT_org'] = m.group()
+            r['SAT_down'] = m.group(3)
             continue
         
-        r['ORG'] += ref + ' '
-    r['ORG'] = r['ORG'].strip()
+        org.append(ref)
+    r['ORG'] = ' '.join(org).strip()
     return r
 
 def toSOTA(decoder, lcount, actp, row, callsign, options):
@@ -699,34 +1207,60 @@ def toSOTA(decoder, lcount, actp, row, callsign, options):
         ]
         return (date2,hisqth['SOTA']!='',l)
 
+adif_fields = [
+    ('STATION_CALLSIGN','activator'),
+    ('CALL','callsign'),
+    ('QSO_DATE','date'),
+    ('TIME_ON','time'),
+    ('BAND','band-wlen'),
+    ('MODE','mode'),
+    ('SUBMODE','sub_mode'),
+    ('RST_SENT','rst_sent'),
+    ('RST_RCVD','rst_rcvd'),
+    ('MY_SIG','mysig'),
+    ('MY_SIG_INFO','mysiginfo'),
+    ('MY_STATE','mystate'),
+    ('SIG','sig'),
+    ('SIG_INFO','siginfo'),
+    ('SOTA_REF', 'sotaref'),
+    ('MY_SOTA_REF','mysotaref'),
+    ('OPERATOR','operator'),
+    ('PROGRAMID','programid'),
+    ('ADIF_VER','adifver')
+]
+adif_tags = {k: field for (field, k) in adif_fields}
+
+def adifLen(value, encoding='utf-8'):
+    # ADIF のフィールド長。出力エンコーディング(UTF-8)でのバイト数
+    if value.isascii():
+        return len(value)
+    return len(value.encode(encoding, 'backslashreplace'))
+
 def adif(key, value):
-    adif_fields = [
-        ('STATION_CALLSIGN','activator'),
-        ('CALL','callsign'),
-        ('QSO_DATE','date'),
-        ('TIME_ON','time'),
-        ('BAND','band-wlen'),
-        ('MODE','mode'),
-        ('SUBMODE','sub_mode'),
-        ('RST_SENT','rst_sent'),
-        ('RST_RCVD','rst_rcvd'),
-        ('MY_SIG','mysig'),
-        ('MY_SIG_INFO','mysiginfo'),
-        ('MY_STATE','mystate'),
-        ('SIG','sig'),
-        ('SIG_INFO','siginfo'),
-        ('SOTA_REF', 'sotaref'),
-        ('MY_SOTA_REF','mysotaref'),
-        ('OPERATOR','operator'),
-        ('PROGRAMID','programid'),
-        ('ADIF_VER','adifver')
-    ]
-    for (field,k) in adif_fields:
-        if key == k:
-            f ='<' + field + ':' + str(len(value)) + '>' + value
-            return f
-    f ='<COMMENT:' + str(len(value)) + '>' + value
-    return f
+    return '<' + adif_tags.get(key, 'COMMENT') + ':' + str(adifLen(value)) + '>' + value
+
+def adifField(buf, key, value):
+    # <TAG:len>value を buf (list) に追加する
+    buf.append('<' + adif_tags.get(key, 'COMMENT') + ':' + str(adifLen(value)) + '>' + value)
+
+class ADIFWriter:
+    # ADIFのレコードを1回の write で書く。
+    # レコードは (key, value) と、そのまま書く文字列の並び。
+    # フィールド長は adif() と同じく adifLen で求める
+    def __init__(self, out, encoding='utf-8'):
+        self.out = out
+        self.encoding = encoding
+
+    def writerow(self, fields):
+        tags = adif_tags
+        buf = []
+        for f in fields:
+            if isinstance(f, str):
+                buf.append(f)
+                continue
+            (key, value) = f
+            buf.append(f'<{tags.get(key, "COMMENT")}:{adifLen(value, self.encoding)}>{value}')
+        self.out.write(' '.join(buf) + '\r\n')
         
 def toADIF(decoder, lcount, mode, row, options):
     try: 
@@ -802,15 +1336,15 @@ def toADIF(decoder, lcount, mode, row, options):
         errorfl = False
           
     l += [
-        adif('activator',activator),
-        adif('operator',operator),
-        adif('callsign',h['callsign']),
-        adif('date',date),
-        adif('time',time),
-        adif('band-wlen',h['band-wlen']),
-        adif('mode',h['mode']),
-        adif('rst_sent',h['rst_sent']),
-        adif('rst_rcvd',h['rst_rcvd']),
+        ('activator',activator),
+        ('operator',operator),
+        ('callsign',h['callsign']),
+        ('date',date),
+        ('time',time),
+        ('band-wlen',h['band-wlen']),
+        ('mode',h['mode']),
+        ('rst_sent',h['rst_sent']),
+        ('rst_rcvd',h['rst_rcvd']),
     ]
     if mode == 'POTA':
         l2 += [
@@ -828,52 +1362,41 @@ def toADIF(decoder, lcount, mode, row, options):
         ]
             
     if mode == 'SOTA':
-        l += [ adif('mysotaref',myref['SOTA']) ]
+        l += [ ('mysotaref',myref['SOTA']) ]
         if  hisref['SOTA'] != '':
-            l+= [adif('sotaref',hisref['SOTA'])]
+            l+= [('sotaref',hisref['SOTA'])]
     elif mode == 'POTA':
-        l += [ adif('mysig','POTA'),
-               adif('mysiginfo',myref['POTA'])]
+        l += [ ('mysig','POTA'),
+               ('mysiginfo',myref['POTA'])]
         if hisref['POTA'] != '':
-            l+= [adif('sig','POTA'),adif('siginfo',hisref['POTA'])]
+            l+= [('sig','POTA'),('siginfo',hisref['POTA'])]
     else:
-        l += [ adif('mysig','WWFF'),
-               adif('mysiginfo',options['WWFFRef'])]
+        l += [ ('mysig','WWFF'),
+               ('mysiginfo',options['WWFFRef'])]
         if hisref['WWFF'] != '':
-            l+= [adif('sig','WWFF'),adif('siginfo',hisref['WWFF'])]
+            l+= [('sig','WWFF'),('siginfo',hisref['WWFF'])]
             
     l+= ['<EOR>']
     
     return (date2, wwffref, l, l2, errorfl)
 
-def toADIF2(decoder, row, options):
-    try:
-        h = decoder(row)
-    except ValueError as err:
-        return ('', [str(err)], {}, str(err))
-
+def headADIF2(h, options):
+    # toADIF2 と checkADIF2 で共通の前処理
     if options['myQTH']=='rmks1':
         myref = get_ref(h['rmks1'])
-        comment = h['rmks2']
     elif options['myQTH']=='rmks2':
         myref = get_ref(h['rmks2'])
-        comment = h['rmks1']
     else:
         myref = get_ref(options['Park'])
-        comment = ''
         
     if options['QTH']=='rmks1':
         hisref = get_ref(h['rmks1'])
-        comment = h['rmks2']
     elif options['QTH']=='rmks2':
         hisref = get_ref(h['rmks2'])
-        comment = h['rmks1']
     elif options['QTH']=='qth':
         hisref = get_ref(h['qth'])
-        comment = h['rmks2']
     else:
         hisref = {'SOTA':'', 'POTA':[],'WWFF':[]}
-        comment = ''
 
     if h['date_error']:
         date = h['date_error']
@@ -900,50 +1423,62 @@ def toADIF2(decoder, row, options):
     else:
         hisref['SOTA'] = []
 
+    if h['sub_mode']:
+        disp_mode = h['mode']+ '/' + h['sub_mode']
+    else:
+        disp_mode = h['mode']
+
+    return (myref, hisref, date, date2, time, disp_mode)
+
+def dispADIF2(h, myref, hisref, date, time, disp_mode, mystate, options):
+    make_str = lambda x : '/'.join(x['SOTA']+ x['WWFF']+ x['POTA'])
+    hisstr = make_str(hisref)
+    mystr = make_str(myref)
+    if mystate:
+        mystr += "(" + mystate + ")"
+    return [
+            h['callsign'],
+            date,
+            time,
+            h['band-wlen'],
+            disp_mode,
+            h['rst_sent'],
+            h['rst_rcvd'],
+            hisstr,
+            mystr,
+            options['POTAActivator'],
+            options['POTAOperator']
+        ]
+
+def toADIF2(decoder, row, options, reftable):
+    try:
+        h = decoder(row)
+    except ValueError as err:
+        return ('', [str(err)], {}, str(err))
+
+    (myref, hisref, date, date2, time, disp_mode) = headADIF2(h, options)
 
     activator = options['POTAActivator']
     operator = options['POTAOperator']
 
     if h['error'] or h['band_error']:
-        qso = [h['errormsg']]
         errorfl = h['errormsg']
     else:
-        qso = []
         errorfl = None
 
-    potacall = h['callsign']
-        
-    qsopota = qso + [
-        adif('activator',activator),
-        adif('operator',operator),
-        adif('callsign',potacall),
-        adif('date',date),
-        adif('time',time),
-        adif('band-wlen',h['band-wlen']),
-    ]
-
-    qso += [
-        adif('activator',activator),
-        adif('operator',operator),
-        adif('callsign',h['callsign']),
-        adif('date',date),
-        adif('time',time),
-        adif('band-wlen',h['band-wlen']),
-    ]
-
-    if h['sub_mode']:
-        qsopota += [adif('mode',h['mode'])] #, adif('sub_mode',h['sub_mode'])]
-        qso += [adif('mode',h['mode'])] #, adif('sub_mode',h['sub_mode'])]
-        disp_mode = h['mode']+ '/' + h['sub_mode']
-    else:
-        qsopota += [adif('mode',h['mode'])]
-        qso += [adif('mode',h['mode'])]
-        disp_mode = h['mode']
-
-    qso += [
-        adif('rst_sent',h['rst_sent']),
-        adif('rst_rcvd',h['rst_rcvd']),
-    ]
+    # 全リファレンスで共通の部分は1回だけ組み立てる
+    buf = [errorfl or '']
+    adifField(buf, 'activator', activator)
+    adifField(buf, 'operator', operator)
+    adifField(buf, 'callsign', h['callsign'])
+    adifField(buf, 'date', date)
+    adifField(buf, 'time', time)
+    adifField(buf, 'band-wlen', h['band-wlen'])
+    adifField(buf, 'mode', h['mode']) #, adif('sub_mode',h['sub_mode'])
+    qsopota = ''.join(buf)
+    adifField(buf, 'rst_sent', h['rst_sent'])
+    adifField(buf, 'rst_rcvd', h['rst_rcvd'])
+    qso = ''.join(buf)
 
     log = {}
 
@@ -951,76 +1486,87 @@ def toADIF2(decoder, row, options):
        log[my] = []
        if hisref['SOTA']:
            for his in hisref['SOTA']:
-               log[my] += qso + [ adif('mysotaref',my),
-                                  adif('sotaref',his),'<EOR>\n']
+               log[my].append(qso + adif('mysotaref',my) +
+                              adif('sotaref',his) + '<EOR>\n')
        else:
-           log[my] += qso + [ adif('mysotaref',my),'<EOR>\n']
+           log[my].append(qso + adif('mysotaref',my) + '<EOR>\n')
 
     mystate = ""
     
     for my in myref['POTA']:
         log[my] = []
 
-        mystates = getPOTALoc(my)
+        mystates = reftable.loc(my)
         if len(mystates) == 1:
             mystate = mystates[0].replace("JP-","")
+
+        buf = [qsopota]
+        adifField(buf, 'mysig', 'POTA')
+        adifField(buf, 'mysiginfo', my)
+        if mystate:
+            adifField(buf, 'mystate', mystate)
+        mine = ''.join(buf)
             
         if hisref['POTA']:
             for his in hisref['POTA']:
-                log[my] += qsopota
-                log[my] += [adif('mysig','POTA'),adif('mysiginfo',my)]
-                if mystate:
-                    log[my] += [ adif('mystate',mystate) ]
-                log[my] += [ adif('sig','POTA'), adif('siginfo',his),'<EOR>\n']
+                log[my].append(mine + adif('sig','POTA') + adif('siginfo',his) + '<EOR>\n')
         else:
-            log[my] += qsopota
-            log[my] += [adif('mysig','POTA'),adif('mysiginfo',my)]
-            if mystate:
-                log[my] += [ adif('mystate',mystate) ]
-            log[my] += ['<EOR>\n']
+            log[my].append(mine + '<EOR>\n')
 
     for my in myref['WWFF']:
         log[my] = []
+        mine = qso + adif('mysig','WWFF') + adif('mysiginfo',my)
         if hisref['WWFF']:
             for his in hisref['WWFF']:
-                log[my] += qso + [
-                    adif('mysig','WWFF'),
-                    adif('mysiginfo',my),
-                    adif('sig','WWFF'),
-                    adif('siginfo',his),'<EOR>\n']
+                log[my].append(mine + adif('sig','WWFF') + adif('siginfo',his) + '<EOR>\n')
         else:
-            log[my] += qso + [
-                adif('mysig','WWFF'),
-                adif('mysiginfo',my),'<EOR>\n']
+            log[my].append(mine + '<EOR>\n')
 
-    make_str = lambda x : '/'.join(x['SOTA']+ x['WWFF']+ x['POTA'])
-    hisstr = make_str(hisref)
-    mystr = make_str(myref)
-    if mystate:
-        mystr += "(" + mystate + ")"
-    ldisp = [
-            potacall,
-            date,
-            time,
-            h['band-wlen'],
-            disp_mode,
-            h['rst_sent'],
-            h['rst_rcvd'],
-            hisstr,
-            mystr,
-            activator,
-            operator
-        ]
+    ldisp = dispADIF2(h, myref, hisref, date, time, disp_mode, mystate, options)
 
     return (date2, ldisp, log, errorfl)
 
-potaloc_cache = {}
+def checkADIF2(decoder, row, options):
+    # toADIF2 から ADIF の組み立てと公園所在地の問い合わせを除いたもの。
+    # 所在地を付けるのは呼び出し側
+    try:
+        h = decoder(row)
+    except ValueError as err:
+        return ('', [str(err)], [], [], str(err))
 
-def getPOTALoc(parkid):
-    global potaloc_cache
-    if parkid in potaloc_cache.keys():
-        return potaloc_cache[parkid]
-    
+    (myref, hisref, date, date2, time, disp_mode) = headADIF2(h, options)
+
+    if h['error'] or h['band_error']:
+        errorfl = h['errormsg']
+    else:
+        errorfl = None
+
+    ldisp = dispADIF2(h, myref, hisref, date, time, disp_mode, '', options)
+    refs = list(dict.fromkeys(myref['SOTA'] + myref['POTA'] + myref['WWFF']))
+
+    return (date2, ldisp, refs, myref['POTA'], errorfl)
+
+def myState(mylocs):
+    # 所在地が1つに決まる公園の都道府県
+    mystate = ""
+    for mystates in mylocs:
+        if len(mystates) == 1:
+            mystate = mystates[0].replace("JP-","")
+    return mystate
+
+potaloc_cache = {}
+# 公園所在地の問い合わせ回数と所要時間(秒)。時間は問い合わせ待ちの経過時間で、
+# 並列に問い合わせたときもまとめて1回分だけ数える
+potaloc_stats = {'hits': 0, 'misses': 0, 'time': 0.0}
+potaloc_lock = threading.Lock()
+
+def countPOTALoc(hits=0, misses=0, elapsed=0.0):
+    with potaloc_lock:
+        potaloc_stats['hits'] += hits
+        potaloc_stats['misses'] += misses
+        potaloc_stats['time'] += elapsed
+
+def fetchPOTALoc(parkid):
     url = f"https://sotaapp2.sotalive.net/api/v2/pota/parks/{parkid}"
     res = requests.get(url)
     if res.status_code == 200:
@@ -1031,18 +1577,154 @@ def getPOTALoc(parkid):
     potaloc_cache[parkid] = r
     return r
 
-def sendAirHamLog(fp, fname, decoder, options, inchar, outchar):
-
-    files = {}
+def getPOTALoc(parkid):
+    if parkid in potaloc_cache.keys():
+        countPOTALoc(hits=1)
+        return potaloc_cache[parkid]
+    
+    start = time.perf_counter()
+    try:
+        return fetchPOTALoc(parkid)
+    finally:
+        countPOTALoc(misses=1, elapsed=time.perf_counter() - start)
+
+POTALOC_WORKERS = 8
+
+def getPOTALocs(parkids):
+    # まとめて問い合わせる。キャッシュにないものは並列に
+    parkids = list(dict.fromkeys(parkids))
+    misses = [p for p in parkids if p not in potaloc_cache]
+    locs = {}
+    if len(misses) > 1:
+        start = time.perf_counter()
+        try:
+            with concurrent.futures.ThreadPoolExecutor(
+                    min(POTALOC_WORKERS, len(misses))) as ex:
+                locs.update(zip(misses, ex.map(fetchPOTALoc, misses)))
+        finally:
+            countPOTALoc(misses=len(misses), elapsed=time.perf_counter() - start)
+    for p in parkids:
+        if p not in locs:
+            locs[p] = getPOTALoc(p)
+    return locs
+
+class RefTable:
+    # 1リクエスト分のリファレンス情報。公園所在地は1回だけ問い合わせ、
+    # 出力ファイル名は (ref, date) ごとに1回だけ作る
+    def __init__(self, act_call):
+        self.act_call = act_call
+        self.locs = {}
+        self.names = {}
+
+    def loc(self, ref):
+        r = self.locs.get(ref)
+        if r is None:
+            r = self.locs[ref] = getPOTALoc(ref)
+        return r
+
+    def prefetch(self, refs):
+        self.locs.update(getPOTALocs([r for r in refs if r not in self.locs]))
+
+    def state(self, mypota):
+        return myState(self.loc(my) for my in mypota)
+
+    def fileName(self, ref, date):
+        fn = self.names.get((ref, date))
+        if fn is None:
+            mloc = self.loc(ref) if isPOTAJP(ref) else []
+            fn = self.names[(ref, date)] = adifFileName(self.act_call, ref, mloc, date)
+        return fn
+
+SNIFF_SIZE = 1024
+adif_head_pat = re.compile(r'ADIF|<EOH>', re.I)
+adif_eoh_pat = re.compile(r'<EOH>', re.I)
+adif_eor_pat = re.compile(r'<EOR>', re.I)
+
+class LogFormat:
+    # detectFormat の結果。records() が 1QSO 分の入力を返し、decoder でデコードする
+    def __init__(self, kind, decoder, header=False):
+        self.kind = kind
+        self.decoder = decoder
+        self.header = header
+        self.isADIF = kind == 'adif'
+
+    def records(self, rows):
+        # rows は csv.reader の行
+        if self.isADIF:
+            return adifRecords(adifBody(rows))
+        if self.header:
+            return itertools.islice(rows, 1, None)
+        return rows
+
+def peekable(fp):
+    return fp if hasattr(fp, 'peek') else io.BufferedReader(fp)
+
+def detectFormat(fp, inchar, decoder=decodeHamlog, wrap=None):
+    # 先頭 SNIFF_SIZE バイトだけ見て HAMLOG / HAMLOG iOS / ADIF を判定する。
+    # fp は peek できること(peekable)。読み位置は変えない。
+    # decoder は HAMLOG CSV のときに使うデコーダ。
+    # wrap を渡すと、どの形式でもデコーダを wrap(decoder) に置き換える(計測用)
+    fmt = sniffFormat(fp, inchar, decoder)
+    if wrap:
+        fmt.decoder = wrap(fmt.decoder)
+    return fmt
+
+def sniffFormat(fp, inchar, decoder):
+    head = fp.peek(SNIFF_SIZE)[:SNIFF_SIZE].decode(inchar, errors='ignore')
+    try:
+        first = next(csv.reader(io.StringIO(head)), [])
+    except csv.Error:
+        first = []
+
+    if first and adif_head_pat.search(first[0]):
+        return LogFormat('adif', decodeADIF)
+
+    if '\n' not in head and '\r' not in head:
+        # 1行目が途中で切れているので最後の列は見ない
+        first = first[:-1]
+    if 'TimeOn' in first:
+        return LogFormat('ios', decodeHamLogIOS, header=True)
+
+    return LogFormat('hamlog', decoder)
+
+def adifBody(rows):
+    # <EOH> の次の行から、列を ',' でつなぎ直した行を返す
+    isbody = False
+    for l in rows:
+        lstr = ','.join(l)
+        if isbody:
+            yield lstr
+        elif adif_eoh_pat.search(lstr):
+            isbody = True
+
+def adifRecords(lines):
+    # <EOR> までの行をつなげて 1QSO 分にする
+    rec = ''
+    for l in lines:
+        rec += l
+        if adif_eor_pat.search(l):
+            yield rec
+            rec = ''
+
+def sendAirHamLog(fp, fname, decoder, options, inchar, outchar, files=None, wrap=None):
+
+    if files is None:
+        files = {}
+    limit = lineLimit(files)
+    truncated = False
     linecount = 0
-    outstr = io.StringIO()
+    outstr = openOutput(files, fname)
     writer = csv.writer(outstr,delimiter=',',
                         quoting=csv.QUOTE_MINIMAL)
+    fp = peekable(fp)
+    fmt = detectFormat(fp, inchar, decoder, wrap)
+    decoder = fmt.decoder
     with io.TextIOWrapper(fp, encoding=inchar,errors="backslashreplace") as f:
-        reader = csv.reader(f)
+        reader = fmt.records(csv.reader(f))
         try:
             for row in reader:
-                if linecount > 100000:
+                if overLimit(linecount, limit):
+                    truncated = True
                     break
                 else:
                     if linecount == 0:
@@ -1053,110 +1735,103 @@ def sendAirHamLog(fp, fname, decoder, options, inchar, outchar):
         except Exception as e:
             outstr.write('Line:{} Error{}'.format(linecount, e))
     
-    files.update({fname : outstr.getvalue()})
+    outstr.close()
+    if truncated:
+        reportTruncated(files, limit)
     return files
                 
-def sendSOTA_A(fp, decoder, callsign, options, inchar, outchar):
+def sendSOTA_A(fp, decoder, callsign, options, inchar, outchar, files=None, wrap=None):
     prefix = 'sota'
     prefix2 = 'sota-s2s-'
-    fname = ''
     fname_adi = ''
-    files = {}
+    if files is None:
+        files = {}
+    limit = lineLimit(files)
+    truncated = False
     linecount = 0
 
-    outstr = io.StringIO()
-    writer = csv.writer(outstr,delimiter=',',
-                        quoting=csv.QUOTE_MINIMAL)
-    outstr_s2s = io.StringIO()
-    writer_s2s = csv.writer(outstr_s2s,delimiter=',',
-                            quoting=csv.QUOTE_MINIMAL)
-    outstr_adif = io.StringIO()
-    writer_adif = csv.writer(outstr_adif, delimiter=' ',
-                             quoting=csv.QUOTE_MINIMAL)
+    # 日付ごと(とS2S)に出力を分ける
+    outcsv = PartitionedCSV(files, delimiter=',', quoting=csv.QUOTE_MINIMAL)
+    outstr_adif = None
+
+    # 時刻順に並べ替えるなら、日付が変わった時点で前の日のファイルを閉じられる
+    ordered = options.get('SortQSO')
+    lastfn = None
+
+    fp = peekable(fp)
+    fmt = detectFormat(fp, inchar, decoder, wrap)
+    decoder = fmt.decoder
+    if fmt.isADIF:
+        options['QTH'] = 'qth'
 
     with io.TextIOWrapper(fp, encoding=inchar, errors="backslashreplace") as f:
-        reader = csv.reader(f)
-        for row in reader:
-            if linecount > 100000:
+        rows = enumerate(fmt.records(csv.reader(f)))
+        if ordered:
+            # 空行は何も出力しないので並べ替える前に除く
+            rows = externalSort((r for r in rows if r[1]),
+                                lambda r: qsoKey(decoder, r[1]))
+        for (lineno, row) in rows:
+            if overLimit(linecount, limit):
+                truncated = True
                 break
             elif row:
-                (d2,ref,ladif,_,_) = toADIF(decoder, linecount, 'SOTA', row, options)
-                (fn, s2s, lcsv) = toSOTA(decoder, linecount, True, row, callsign, options)
+                (d2,ref,ladif,_,_) = toADIF(decoder, lineno, 'SOTA', row, options)
+                (fn, s2s, lcsv) = toSOTA(decoder, lineno, True, row, callsign, options)
 
                 if ladif:
-                    if linecount==0:
+                    if linecount==0 and d2 != '':
                         fname_adi = d2
+                        outstr_adif = openOutput(files, prefix + fname_adi + '.adi')
+                        writer_adif = ADIFWriter(outstr_adif)
                         outstr_adif.write('ADIF Export from HAMLOG by JL1NIE\n')
                         outstr_adif.write(adif('programid','FCTH')+'\n')
                         outstr_adif.write(adif('adifver','3.0.6')+'\n')
                         outstr_adif.write('<EOH>\n')
-                    writer_adif.writerow(ladif)
+                    if outstr_adif:
+                        writer_adif.writerow(ladif)
 
                 if lcsv:
-                    if linecount==0:
-                        fname = fn
-
-                    if fn == fname:
-                        writer.writerow(lcsv)
-                        if s2s:
-                            writer_s2s.writerow(lcsv)
-                    else:
-                        name = prefix + fname + '.csv'
-                        files.update({name : outstr.getvalue()})
-                        
-                        s2sbuff = outstr_s2s.getvalue()
-                        if len(s2sbuff) >0:
-                            name2 = prefix2 + fname + '.csv'
-                            files.update({name2 : s2sbuff})
-                        
-                        outstr = io.StringIO()
-                        writer = csv.writer(outstr,delimiter=',',
-                                            quoting=csv.QUOTE_MINIMAL)
-                        writer.writerow(lcsv)
-
-                        outstr_s2s = io.StringIO()
-                        writer_s2s = csv.writer(outstr_s2s,delimiter=',',
-                                                quoting=csv.QUOTE_MINIMAL)
-                        if s2s:
-                            writer_s2s.writerow(lcsv)
-                        fname = fn
+                    if ordered and fn != lastfn:
+                        outcsv.close()
+                        lastfn = fn
+                    outcsv.writerow(prefix + fn + '.csv', lcsv)
+                    if s2s:
+                        outcsv.writerow(prefix2 + fn + '.csv', lcsv)
 
             linecount += 1
 
-        if fname_adi != '': 
-            name = prefix + fname_adi + '.adi'
-            files.update({name : outstr_adif.getvalue()})
-
-        if fname != '':
-            name = prefix + fname + '.csv'
-            files.update({name : outstr.getvalue()})
-
-            s2sbuff = outstr_s2s.getvalue()
-            if len(s2sbuff) > 0:
-                name2 = prefix2 + fname + '.csv'
-                files.update({name2 : s2sbuff})
+        if outstr_adif:
+            outstr_adif.close()
+        outcsv.close()
 
+    if truncated:
+        reportTruncated(files, limit)
     return(files)
 
-def sendSOTA_C(fp, decoder, callsign, options, inchar, outchar):
+def sendSOTA_C(fp, decoder, callsign, options, inchar, outchar, files=None, wrap=None):
     prefix = 'sota'
     fname = ''
-    files = {}
+    if files is None:
+        files = {}
+    limit = lineLimit(files)
+    truncated = False
     linecount = 0
 
-    outstr = io.StringIO()
-    writer = csv.writer(outstr,delimiter=',',
-                        quoting=csv.QUOTE_MINIMAL)
+    # ファイル名は最初の行で決まるので、出力は最初に書くときに開く
+    outstr = None
+    outstr_nonsota = None
 
-    outstr_nonsota = io.StringIO()
-    writer_nonsota = csv.writer(outstr_nonsota,delimiter=',',
-                              quoting=csv.QUOTE_MINIMAL)
-    nonsota_fl = False
+    fp = peekable(fp)
+    fmt = detectFormat(fp, inchar, decoder, wrap)
+    decoder = fmt.decoder
+    if fmt.isADIF:
+        options['QTH'] = 'qth'
     
     with io.TextIOWrapper(fp, encoding=inchar,errors="backslashreplace") as f:
-        reader = csv.reader(f)
+        reader = fmt.records(csv.reader(f))
         for row in reader:
-            if linecount > 100000:
+            if overLimit(linecount, limit):
+                truncated = True
                 break
             elif row:
                 (fn,his_summit,l) = toSOTA(decoder, linecount, False, row, callsign, options)
@@ -1164,134 +1839,239 @@ def sendSOTA_C(fp, decoder, callsign, options, inchar, outchar):
                     fname = fn
                     
                 if his_summit:
+                    if not outstr:
+                        outstr = openOutput(files, prefix + fname + '.csv')
+                        writer = csv.writer(outstr,delimiter=',',
+                                            quoting=csv.QUOTE_MINIMAL)
                     writer.writerow(l)
                 else:
+                    if not outstr_nonsota:
+                        outstr_nonsota = openOutput(files, 'other' + fname + '.csv')
+                        writer_nonsota = csv.writer(outstr_nonsota,delimiter=',',
+                                                    quoting=csv.QUOTE_MINIMAL)
                     writer_nonsota.writerow(l)
-                    nonsota_fl = True
             linecount += 1
 
-        name = prefix + fname + '.csv'
-        files.update({name : outstr.getvalue()})
-        if nonsota_fl :
-            name = 'other'+ fname + '.csv'
-            files.update({name : outstr_nonsota.getvalue()})
+        if outstr:
+            outstr.close()
+        else:
+            files[prefix + fname + '.csv'] = ''
+        if outstr_nonsota:
+            outstr_nonsota.close()
         
+    if truncated:
+        reportTruncated(files, limit)
     return(files)
 
-def sendADIF(fp, options, inchar, outchar):
-    files = {}
+class CSVReadError(Exception):
+    pass
+
+def readRows(reader):
+    # csv の読み込みエラーを変換中のエラーと区別する
+    try:
+        yield from reader
+    except Exception as e:
+        raise CSVReadError(e) from e
+
+def adifInput(f, fmt, options, res):
+    # 1QSO分の入力を読みながら返す。
+    # 入力が空か読めないときは res に書いて None を返す
+    (operator,portable) = splitCallsign(options['POTAActivator'])
+    if not options['POTAOperator']:
+        options['POTAOperator'] = operator
+
+    reader = readRows(csv.reader(f))
+    try:
+        first = next(reader, None)
+    except CSVReadError as e:
+        res['status'] = 'NG'
+        res['errorlog'] = f'CSVファイルにエラーがあります({e})'
+        return None
+
+    if not first:
+        res['status'] = 'NG'
+        res['errorlog'] = '入力ファイルが空です'
+        return None
+
+    if fmt.isADIF:
+        options['QTH'] = 'qth'
+
+    return fmt.records(itertools.chain([first], reader))
+
+def sortADIF(records, decoder, ordered):
+    # (入力での番号, row) を返す。ordered なら時刻順
+    records = enumerate(records)
+    if ordered:
+        records = externalSort(records, lambda r: qsoKey(decoder, r[1]))
+    return records
+
+def isPOTAJP(ref):
+    return 'JA-' in ref or 'JP-' in ref
+
+def adifFileName(act_call, ref, mloc, date):
+    if len(mloc) > 1:
+        cndt = map(lambda x: x.replace('JP-',""), mloc)
+        mlocmesg = '[' + ','.join(list(cndt)) + ']'
+        fn = act_call.replace('/','-') + '@' + ref.replace('/','-') + '-' + mlocmesg + '-' + date +'.adi'
+    else:
+        fn = act_call.replace('/','-') + '@' + ref.replace('/','-') + '-' + date +'.adi'
+    return fn
+
+def sendADIF(fp, options, inchar, outchar, files=None, wrap=None):
+    if files is None:
+        files = {}
+    limit = lineLimit(files)
     potafiles = []
     res = {'status':'OK','errorlog':[], 'logtext':[],'filelist':[]}
     header = 'ADIF Export from HAMLOG by JL1NIE\n'+ adif('programid','FCTH')+ '\n' + adif('adifver','3.1.4')+'\n' + '<EOH>\n'
     
-    act_call = options['POTAActivator']
-    (operator,portable) = splitCallsign(act_call)
+    reftable = RefTable(options['POTAActivator'])
+    linecount = 0
 
-    if not options['POTAOperator']:
-        options['POTAOperator'] = operator
+    ordered = options.get('SortQSO')
 
-    lines = []
+    fp = peekable(fp)
+    fmt = detectFormat(fp, inchar, wrap=wrap)
+    decoder = fmt.decoder
     with io.TextIOWrapper(fp, encoding=inchar,errors="backslashreplace") as f:
-        try:
-            reader = csv.reader(f)
-            for row in reader:
-                lines += [row]
-        except Exception as e:
-            res['status'] = 'NG'
-            res['errorlog'] = 'CSVファイルにエラーがあります({e})'
+        records = adifInput(f, fmt, options, res)
+        if records is None:
             return files, res
-    
-    decoder = None
-    linecount = 0
-    isADIF = False
-
-    if lines and lines[0]:
-        firstline = lines[0][0].upper()
-        if 'ADIF' in firstline or '<EOH>' in firstline:
-            r = lines
-            lines = []
-            isADIF = True
-            isbody = False
-            options['QTH'] = 'qth'
-            for l in r:
-                lstr = ','.join(l)
-                if isbody:
-                    lines.append(lstr)
-                elif '<EOH>' in lstr.upper():
-                    isbody = True
-    else:
-        res['status'] = 'NG'
-        res['errorlog'] = '入力ファイルが空です'
-        return files, res
-    
-    first_date = ''
-    rows = ''
-    
-    for row in lines:
-        if linecount > 100000:
-            break
 
-        if not decoder:
-            if 'TimeOn' in row:
-                decoder = decodeHamLogIOS
-                continue
-            elif isADIF:
-                decoder = decodeADIF
-            else:
-                decoder = decodeHamlog
+        first_date = ''
+        # 出力ファイルごとのバッファ。出現順に閉じる
+        outputs = {}
+        # QSOの日付で分けるファイル。時刻順なら日付が変わったら閉じる
+        dated = []
+        last_date = None
 
-        if isADIF:
-            if '<EOR>' in row.upper():
-                rows += row
-                (d, ldisp, log, errorfl) = toADIF2(decoder, rows, options)
-                rows = ''
-            else:
-                rows += row
-                continue
-        else:
-            (d, ldisp, log, errorfl) = toADIF2(decoder, row, options)
+        try:
+            for (lineno, row) in sortADIF(records, decoder, ordered):
+                if overLimit(linecount, limit):
+                    msg = reportTruncated(files, limit)
+                    res['truncated'] = limit
+                    res['errorlog'].append(msg.strip())
+                    break
+
+                (d, ldisp, log, errorfl) = toADIF2(decoder, row, options, reftable)
         
-        if not first_date:
-            first_date = d
+                if not first_date:
+                    first_date = d
+
+                if ordered and d != last_date:
+                    for fn in dated:
+                        outputs.pop(fn).close()
+                    dated = []
+                    last_date = d
             
-        if errorfl:
-            res['status'] = 'NG'
-            res['errorlog'].append(f"{linecount+1}行:{errorfl}")
-            ldisp.append(errorfl)
+                if errorfl:
+                    res['status'] = 'NG'
+                    res['errorlog'].append(f"{lineno+1}行:{errorfl}")
+                    ldisp.append(errorfl)
             
-        if ldisp:
-            res['logtext'].append(ldisp)
-
-        for ref in log.keys():
-            if 'JA-' in ref or 'JP-' in ref:
-                mloc = getPOTALoc(ref)
-                date = first_date
-            elif '/' in ref:
-                mloc = []
-                date = d
-            else:
-                mloc = []
-                date = first_date
+                if ldisp:
+                    res['logtext'].append(ldisp)
 
-            if len(mloc) > 1:
-                cndt = map(lambda x: x.replace('JP-',""), mloc)
-                mlocmesg = '[' + ','.join(list(cndt)) + ']'
-                fn = act_call.replace('/','-') + '@' + ref.replace('/','-') + '-' + mlocmesg + '-' + date +'.adi'
-            else:
-                fn = act_call.replace('/','-') + '@' + ref.replace('/','-') + '-' + date +'.adi'
+                for ref in log.keys():
+                    # SOTAはQSOの日付、それ以外は最初のQSOの日付
+                    if '/' in ref and not isPOTAJP(ref):
+                        fn = reftable.fileName(ref, d)
+                    else:
+                        fn = reftable.fileName(ref, first_date)
+                
+                    out = outputs.get(fn)
+                    if out == None:
+                        out = outputs[fn] = openOutput(files, fn)
+                        out.write(header)
+                        if '/' in ref and not isPOTAJP(ref):
+                            dated.append(fn)
+
+                    if log[ref]:
+                        out.write(''.join(log[ref]))
+
+                    if isPOTAJP(ref):
+                        potafiles.append(fn)
                 
-            if files.get(fn) == None:
-                files[fn] = header
+                linecount += 1
 
-            if log[ref]:
-                files[fn] += ''.join(log[ref])
+        except CSVReadError as e:
+            # 途中まで変換した結果は捨てる
+            for out in outputs.values():
+                out.discard()
+            res = {'status':'NG', 'errorlog':f'CSVファイルにエラーがあります({e})',
+                   'logtext':[], 'filelist':[]}
+            return files, res
+
+    for out in outputs.values():
+        out.close()
 
-            if 'JA-' in ref or 'JP-' in ref:
-                potafiles.append(fn)
-                
-        linecount += 1
-        
     res['filelist'] = sorted(set(potafiles), key=potafiles.index)
     res['errorlog'] = "\n".join(res['errorlog'])
     
     return files,res
+
+def checkADIF(fp, options, inchar, outchar, wrap=None):
+    # ADIFCSVCheck 用。sendADIF と同じ res を返すが、ADIFは組み立てない。
+    # 公園所在地は最後にまとめて問い合わせる
+    limit = STREAM_MAX_LINES
+    res = {'status':'OK','errorlog':[], 'logtext':[],'filelist':[]}
+    reftable = RefTable(options['POTAActivator'])
+    linecount = 0
+
+    fp = peekable(fp)
+    fmt = detectFormat(fp, inchar, wrap=wrap)
+    decoder = fmt.decoder
+    with io.TextIOWrapper(fp, encoding=inchar,errors="backslashreplace") as f:
+        records = adifInput(f, fmt, options, res)
+        if records is None:
+            return res
+
+        first_date = ''
+        parks = {}
+        pending = []
+
+        try:
+            for (lineno, row) in sortADIF(records, decoder, options.get('SortQSO')):
+                if overLimit(linecount, limit):
+                    res['truncated'] = limit
+                    res['errorlog'].append(
+                        f"入力が{limit}行を超えたため、以降の行は確認していません。")
+                    break
+
+                (d, ldisp, refs, mypota, errorfl) = checkADIF2(decoder, row, options)
+
+                if not first_date:
+                    first_date = d
+
+                if errorfl:
+                    res['status'] = 'NG'
+                    res['errorlog'].append(f"{lineno+1}行:{errorfl}")
+                    ldisp.append(errorfl)
+
+                if ldisp:
+                    res['logtext'].append(ldisp)
+
+                # 表示の所在地は問い合わせ後に付ける
+                if mypota:
+                    pending.append((ldisp, mypota))
+
+                for ref in refs:
+                    if isPOTAJP(ref):
+                        parks[ref] = True
+
+                linecount += 1
+
+        except CSVReadError as e:
+            return {'status':'NG', 'errorlog':f'CSVファイルにエラーがあります({e})',
+                    'logtext':[], 'filelist':[]}
+
+    reftable.prefetch(list(parks) + [my for (_, mypota) in pending for my in mypota])
+    for (ldisp, mypota) in pending:
+        mystate = reftable.state(mypota)
+        if mystate:
+            ldisp[8] += "(" + mystate + ")"
+
+    res['filelist'] = [reftable.fileName(ref, first_date) for ref in parks]
+    res['errorlog'] = "\n".join(res['errorlog'])
+
+    return res
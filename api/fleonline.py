@@ -3,6 +3,8 @@
 import cgi
 import csv
 import datetime
+import functools
+import hashlib
 import io
 import json
 import logging
@@ -17,7 +19,18 @@ from api.convutil import (
     mode_to_airhammode,
     mode_to_SOTAmode,
     mode_to_ADIFmode,
-    adif
+    adif,
+    LRUCache,
+    ADIFWriter,
+    PartitionedCSV,
+    externalSort,
+    ZipStream,
+    zipLevel,
+    isStream,
+    openOutput,
+    lineLimit,
+    overLimit,
+    reportTruncated
 )
 
 
@@ -150,71 +163,53 @@ def parseCallsign(c):
                         return None
 
 
-def get_token(pos, line):
-    res = ''
-    while pos < len(line):
-        c = line[pos]
-        if c == ' ' or c == '　':
-            if res != '':
-                return (pos+1, res)
-            else:
-                pos += 1
-        elif c in '#<[{':
-            return (pos+1, c)
-        else:
-            res = res + c
-            pos += 1
-    return (pos, res)
-
-
-def get_comment(pos, line):
-    res = ""
-    while pos < len(line):
-        c = line[pos]
-        if c in '>]}':
-            return (pos+1, res)
-        else:
-            res = res + c
-            pos += 1
-    return (pos, res)
-
-
+# 区切りは半角/全角スペース。'#<[{' の直前の語は捨てる(従来の get_token と同じ)
+token_pat = re.compile(
+    r'[<\[{](?P<comment>[^>\]}]*)[>\]}]?'
+    r'|(?P<stop>#)'
+    r'|[^ 　#<\[{]+(?=[#<\[{])'
+    r'|(?P<word>[^ 　#<\[{]+)')
+date3_pat = re.compile(r'(\d+)([-/])(\d+)\2(\d+)$')
+date2_pat = re.compile(r'(\d+)[-/](\d+)$')
+freq_pat = re.compile(r'\d+\.\d+$')
+snr_pat = re.compile(r'[-\+]\d+$')
+wwffref_pat = re.compile(r'\w+FF-\d+$')
+sotaref_pat = re.compile(r'\w+/\w+-\d+$')
+potaref_pat = re.compile(r'\w+-\d+$')
+dec_pat = re.compile(r'\d+$')
+ctstsent_pat = re.compile(r'\.\w+')
+ctstrcvd_pat = re.compile(r',\w+')
+
+
+@functools.lru_cache(maxsize=8192)
 def tokenizer(line):
     res = []
-    pos = 0
 
-    while pos < len(line):
-        pos, word = get_token(pos, line)
-        w = word.upper()
-        if w == '#':
-            break
-        if w == '':
-            continue
-        if w in '<[{':
-            pos, comment = get_comment(pos, line)
-            res.append(('comment', w, comment))
-            continue
-        m = re.match(r'(\d+)-(\d+)-(\d+)$', w)
-        if m:
-            res.append(('date', (m.group(1), m.group(2), m.group(3)), w))
+    for t in token_pat.finditer(line):
+        kind = t.lastgroup
+        if kind == 'word':
+            word = t.group('word')
+        elif kind == 'comment':
+            res.append(('comment', t.group()[0], t.group('comment')))
             continue
-        m = re.match(r'(\d+)-(\d+)$', w)
-        if m:
-            res.append(('date2', (m.group(1), m.group(2)), w))
+        elif kind == 'stop':
+            break
+        else:
             continue
-        m = re.match(r'(\d+)/(\d+)/(\d+)$', w)
+        w = word.upper()
+        m = date3_pat.match(w)
         if m:
-            res.append(('date', (m.group(1), m.group(2), m.group(3)), w))
+            res.append(('date', (m.group(1), m.group(3), m.group(4)), w))
             continue
-        m = re.match(r'(\d+)/(\d+)$', w)
+        m = date2_pat.match(w)
         if m:
             res.append(('date2', (m.group(1), m.group(2)), w))
             continue
-        m = re.match(r'\d+\.\d+$', w)
+        m = freq_pat.match(w)
         if m:
             res.append(('freq', freq_to_band(w), w))
             continue
-        m = re.match(r'[-\+]\d+$', w)
+        m = snr_pat.match(w)
         if m:
             res.append(('snr', w, w))
             continue
@@ -222,15 +217,15 @@ def tokenizer(line):
         if bd:
             res.append(('band', bd, word))
             continue
-        m = re.match(r'\w+FF-\d+$', w)
+        m = wwffref_pat.match(w)
         if m:
             res.append(('wwffref', w, word))
             continue
-        m = re.match(r'\w+/\w+-\d+$', w)
+        m = sotaref_pat.match(w)
         if m:
             res.append(('sotaref', w, word))
             continue
-        m = re.match(r'\w+-\d+$', w)
+        m = potaref_pat.match(w)
         if m:
             res.append(('potaref', w, word))
             continue
@@ -251,7 +246,7 @@ def tokenizer(line):
         if md:
             res.append(('md', md, word))
             continue
-        m = re.match(r'\d+$', w)
+        m = dec_pat.match(w)
         if m:
             res.append(('dec', len(w), w))
             continue
@@ -259,33 +254,35 @@ def tokenizer(line):
         if m:
             res.append(('call', w.upper(), word))
             continue
-        m = re.match(r'\.\w+', w)
+        m = ctstsent_pat.match(w)
         if m:
             res.append(('ctstsent', w.upper(), word))
             continue
-        m = re.match(r',\w+', w)
+        m = ctstrcvd_pat.match(w)
         if m:
             res.append(('ctstrcvd', w.upper(), word))
             continue
-        m = re.match(r'.*[/\-]+.*', w)
-        if m:
+        if '/' in w or '-' in w:
             res.append(('unknown', w, word))
             continue
         else:
             res.append(('literal', w.upper(), word))
             continue
-    return (res)
+    return tuple(res)
+
+
+@functools.lru_cache(maxsize=64)
+def fixedTZ(hours):
+    return datetime.timezone(datetime.timedelta(hours=hours))
 
 
 def trans_tz(env):
     if env['timezone']:
-        lotz = datetime.timedelta(hours=int(env['timezone']))
         dt_local = datetime.datetime(
             env['c_year'], env['c_month'], env['c_day'],
             env['c_hour'], env['c_min'], 0,
-            tzinfo=datetime.timezone(lotz))
-        utctz = datetime.timedelta(hours=0)
-        dt_utc = dt_local.astimezone(datetime.timezone(utctz))
+            tzinfo=fixedTZ(int(env['timezone'])))
+        dt_utc = dt_local.astimezone(datetime.timezone.utc)
 
         env['utc_year'] = dt_utc.year
         env['utc_month'] = dt_utc.month
@@ -302,11 +299,56 @@ def trans_tz(env):
     return env
 
 
-def compileFLE(input_text, conv_mode):
-    res = []
-    hamlogres = []
-    (NORM, FREQ, RSTS, RSTR) = (1, 2, 3, 4)
-    env = {
+fle_cache = LRUCache(maxsize=64, maxbytes=32 * 1024 * 1024)
+# 解釈結果(cacheSize)は入力の30倍ほどになる。これより大きい入力は
+# キャッシュに入らないので、レコードのリストを作らずに変換する
+FLE_CACHE_INPUT_MAX = fle_cache.maxbytes // 32
+
+
+def compileFLE(input_text, conv_mode, store_input=False, sort_qso=False):
+    # キャッシュするのはモードによらない解釈結果(parseFLE)だけで、
+    # 表示用の結果もZIPも毎回そこから作る。解釈表示のあとにダウンロードしても
+    # 入力の解釈は1回で済み、返した結果を呼び出し側が変更してもキャッシュは壊れない
+    if len(input_text) > FLE_CACHE_INPUT_MAX:
+        return buildFLE(input_text, conv_mode, store_input, sort_qso,
+                        streamFLE(input_text))
+    digest = hashlib.sha256(
+        input_text.encode('utf-8', 'surrogatepass')).hexdigest()
+    parsed = fle_cache.get(digest)
+    if parsed is None:
+        parsed = parseFLE(input_text)
+        fle_cache.put(digest, parsed)
+    return buildFLE(input_text, conv_mode, store_input, sort_qso, parsed)
+
+
+def parseFLE(input_text):
+    # (QSOレコードのリスト, env)。レコードは deriveFLE で派生フィールドが
+    # 足されるだけなので、何度変換に使ってもよい
+    env = newFLEEnv()
+    records = list(qsoRecords(iterFLE(input_text.splitlines(), env)))
+    return (records, env)
+
+
+class FLERecords:
+    # 走査のたびに入力を解釈し直すQSOレコード列。リストは持たない
+    def __init__(self, input_text):
+        self.input_text = input_text
+
+    def __iter__(self):
+        return qsoRecords(iterFLE(self.input_text.splitlines(), newFLEEnv()))
+
+
+def streamFLE(input_text):
+    # parseFLE と同じ (レコード, env) を返す。出力ファイル名やエラーの有無は
+    # 最後まで解釈した env で決まるので、先に1回空読みして env だけ求める
+    env = newFLEEnv()
+    for _ in qsoRecords(iterFLE(input_text.splitlines(), env)):
+        pass
+    return (FLERecords(input_text), env)
+
+
+def newFLEEnv():
+    return {
         'mycall': '',
         'operator': '',
         'qslmsg': '',
@@ -333,49 +375,256 @@ def compileFLE(input_text, conv_mode):
         'c_band': '',
         'c_freq': '',
         'c_mode': 'cw',
-        'c_call': '',
         'c_rigset': 0,
-        'c_his_wwff': '',
-        'c_his_pota': [],
-        'c_his_sota': '',
-        'c_his_num': '',
-        'c_my_num': '',
-        'c_r_s': 5,
-        'c_s_s': 9,
-        'c_t_s': 9,
-        'c_r_r': 5,
-        'c_s_r': 9,
-        'c_t_r': 9,
         'errno': [],
         'ctstnum': None,
         'ctstlit': None,
+        'sotafl': False,
+        'wwfffl': False,
+        'potafl': False,
+        'ctstfl': False,
+        'qsoc': 0,
     }
 
-    lines = input_text.splitlines()
+
+(NORM, FREQ, RSTS, RSTR) = (1, 2, 3, 4)
+
+
+class QSOLine:
+    # QSO行ごとの一時状態
+    __slots__ = ('r_s', 's_s', 't_s', 'r_r', 's_r', 't_r', 'call',
+                 'snr_s', 'snr_r', 'his_wwff', 'his_sota', 'his_pota',
+                 'qso_msg', 'qso_rmks', 'qsl_msg', 'his_num', 'my_num')
+
+    def __init__(self):
+        self.r_s = 5
+        self.s_s = 9
+        self.t_s = 9
+        self.r_r = 5
+        self.s_r = 9
+        self.t_r = 9
+        self.call = ''
+        self.snr_s = '-10'
+        self.snr_r = '-10'
+        self.his_wwff = ''
+        self.his_sota = ''
+        self.his_pota = []
+        self.qso_msg = ''
+        self.qso_rmks = ''
+        self.qsl_msg = ''
+        self.his_num = ''
+        self.my_num = ''
+
+
+def onComment(env, q, tl, pos, lc, state):
+    (_, p1, p2) = tl[pos]
+    if p1 == '<':
+        q.qso_msg = p2
+    elif p1 == '{':
+        q.qso_rmks = p2
+    elif p1 == '[':
+        q.qsl_msg = p2
+    return (pos + 1, state)
+
+def onMode(env, q, tl, pos, lc, state):
+    env['c_mode'] = tl[pos][1]
+    return (pos + 1, NORM)
+
+def onBand(env, q, tl, pos, lc, state):
+    p2 = tl[pos][2]
+    env['c_band'] = p2
+    env['c_freq'] = band_to_freq(p2, True)
+    return (pos + 1, FREQ)
+
+def onTime(env, q, tl, pos, lc, state):
+    (_, p1, p2) = tl[pos]
+    if p1 == 1:
+        env['c_min'] = int(env['c_min']//10)*10 + int(p2)
+    elif p1 == 2:
+        env['c_min'] = int(p2) % 60
+    elif p1 == 3:
+        h = int(p2) // 100
+        m = int(p2) % 60
+        env['c_hour'] = int(env['c_hour']//10)*10 + h
+        env['c_min'] = m
+    elif p1 == 4:
+        h = int(p2) // 100
+        m = int(p2) % 100 % 60
+        env['c_hour'] = h
+        env['c_min'] = m
+    else:
+        env['errno'].append(
+            (lc, pos, 'Wrong time format.'))
+    return (pos + 1, NORM)
+
+def onFreq(env, q, tl, pos, lc, state):
+    p2 = tl[pos][2]
+    env['c_freq'] = p2
+    (f, _, b) = freq_to_band(p2)
+    if f == 'Out of the band':
+        env['errno'].append((lc, pos, 'Unknown band.'))
+    env['c_band'] = b
+    return (pos + 1, NORM)
+
+def onBandFreq(env, q, tl, pos, lc, state):
+    p2 = tl[pos][2]
+    env['c_freq'] = p2
+    (f, _, b) = freq_to_band(p2)
+    if f == 'Out of the band':
+        env['errno'].append((lc, pos, 'Out of the band.'))
+    env['c_band'] = b
+    return (pos + 1, NORM)
+
+def onWWFF(env, q, tl, pos, lc, state):
+    q.his_wwff = tl[pos][1]
+    return (pos + 1, NORM)
+
+def onPOTA(env, q, tl, pos, lc, state):
+    q.his_pota += [tl[pos][1]]
+    return (pos + 1, NORM)
+
+def onSOTA(env, q, tl, pos, lc, state):
+    q.his_sota = tl[pos][1]
+    return (pos + 1, NORM)
+
+def onCall(env, q, tl, pos, lc, state):
+    p1 = tl[pos][1]
+    if q.call != '':
+        env['errno'].append(
+            (lc, pos, 'Each line must contains only one callsign: '+p1))
+    if env['c_band'] == '' and env['c_freq'] == '':
+        env['errno'].append(
+            (lc, pos, 'Band or frequency must be specified before QSO.'))
+    q.call = p1
+    env['qsoc'] += 1
+    return (pos + 1, RSTS)
+
+def onCtstRcvd(env, q, tl, pos, lc, state):
+    q.my_num = tl[pos][1].replace(',', '')
+    if not q.his_num:
+        if env['ctstnum']:
+            q.his_num = f"{env['ctstnum']:03}"
+            env['ctstnum'] += 1
+        elif env['ctstlit']:
+            q.his_num = env['ctstlit']
+    return (pos + 1, NORM)
+
+def onCtstSent(env, q, tl, pos, lc, state):
+    s = tl[pos][1].replace('.', '')
+    if env['ctstnum']:
+        try:
+            num = int(s)
+        except Exception as e:
+            num = 1
+        env['ctstnum'] = num + 1
+        q.his_num = f"{num:03}"
+    elif env['ctstlit']:
+        q.his_num = s.upper()
+    return (pos + 1, NORM)
+
+def onLiteral(env, q, tl, pos, lc, state):
+    q.qso_msg = tl[pos][2]
+    pos += 1
+    if pos < len(tl):
+        (t, p1, p2) = tl[pos]
+        if t == 'literal':
+            q.qso_rmks = p2
+            pos += 1
+    return (pos, NORM)
+
+def onUnknown(env, q, tl, pos, lc, state):
+    env['errno'].append((lc, pos, 'Unknown literal: '+tl[pos][2]))
+    return (pos + 1, NORM)
+
+def onRSTSent(env, q, tl, pos, lc, state):
+    (_, p1, p2) = tl[pos]
+    if p1 == 1:
+        q.s_s = int(p2)
+    elif p1 == 2:
+        q.r_s = int(p2)//10
+        q.s_s = int(p2)%10
+    elif p1 == 3:
+        q.r_s = int(p2)//100
+        q.s_s = (int(p2)%100)//10
+        q.t_s = int(p2)%10
+    else:
+        env['errno'].append((lc,pos,'Wrong RST format.'))
+        return (pos, NORM)
+    return (pos + 1, RSTR)
+
+def onSNRSent(env, q, tl, pos, lc, state):
+    q.snr_s = tl[pos][1]
+    return (pos + 1, RSTR)
+
+def onRSTRcvd(env, q, tl, pos, lc, state):
+    (_, p1, p2) = tl[pos]
+    if p1 == 1:
+        q.s_r = int(p2)
+    elif p1 == 2:
+        q.r_r = int(p2)//10
+        q.s_r = int(p2)%10
+    elif p1 == 3:
+        q.r_r = int(p2)//100
+        q.s_r = (int(p2)%100)//10
+        q.t_r = int(p2)%10
+    else:
+        env['errno'].append((lc,pos,'Wrong RST format.'))
+        return (pos, NORM)
+    return (pos + 1, NORM)
+
+def onSNRRcvd(env, q, tl, pos, lc, state):
+    q.snr_r = tl[pos][1]
+    return (pos + 1, NORM)
+
+def onOther(env, q, tl, pos, lc, state):
+    # 読み進めずに NORM で再解釈
+    return (pos, NORM)
+
+qso_dispatch = {
+    (NORM, 'md'): onMode,
+    (NORM, 'band'): onBand,
+    (NORM, 'dec'): onTime,
+    (NORM, 'freq'): onFreq,
+    (NORM, 'wwffref'): onWWFF,
+    (NORM, 'potaref'): onPOTA,
+    (NORM, 'sotaref'): onSOTA,
+    (NORM, 'call'): onCall,
+    (NORM, 'ctstrcvd'): onCtstRcvd,
+    (NORM, 'ctstsent'): onCtstSent,
+    (NORM, 'literal'): onLiteral,
+    (FREQ, 'freq'): onBandFreq,
+    (RSTS, 'dec'): onRSTSent,
+    (RSTS, 'snr'): onSNRSent,
+    (RSTR, 'dec'): onRSTRcvd,
+    (RSTR, 'snr'): onSNRRcvd,
+}
+for st in (NORM, FREQ, RSTS, RSTR):
+    qso_dispatch[(st, 'comment')] = onComment
+
+qso_default = {
+    NORM: onUnknown,
+    FREQ: onOther,
+    RSTS: onOther,
+    RSTR: onOther,
+}
+
+
+def iterFLE(lines, env=None):
+    if env is None:
+        env = newFLEEnv()
+    dispatch = qso_dispatch
+    default = qso_default
+    errors = env['errno']
+    nerr = 0
     lc = 0
-    qsoc = 0
-    sotafl = False
-    wwfffl = False
-    potafl = False
-    ctstfl = False
 
     for l in lines:
-        env['c_r_s'] = 5
-        env['c_s_s'] = 9
-        env['c_t_s'] = 9
-        env['c_r_r'] = 5
-        env['c_s_r'] = 9
-        env['c_t_r'] = 9
-        env['c_call'] = ''
-        env['c_snr_s'] = '-10'
-        env['c_snr_r'] = '-10'
-        env['c_his_wwff'] = ''
-        env['c_his_sota'] = ''
-        env['c_his_pota'] = []
-        env['c_qso_msg'] = ''
-        env['c_qso_rmks'] = ''
-        env['c_his_num'] = ''
-        env['c_my_num'] = ''
+        # 前の行で検出したエラーを送出
+        while nerr < len(errors):
+            yield ('error', errors[nerr])
+            nerr += 1
+        l = l.rstrip('\r\n')
+        q = None
 
         tl = tokenizer(l)
         if not tl:
@@ -445,7 +694,7 @@ def compileFLE(input_text, conv_mode):
                     (id, ref, w) = tl[pos+1]
                     if id == 'wwffref':
                         env['mywwff'] = ref
-                        wwfffl = True
+                        env['wwfffl'] = True
                     else:
                         env['errno'].append(
                             (lc, pos+1, f"{ref} is invalid WWFF ref#."))
@@ -458,7 +707,7 @@ def compileFLE(input_text, conv_mode):
                     (id, ref, w) = tl[pos+1]
                     if id == 'sotaref':
                         env['mysota'] = ref
-                        sotafl = True
+                        env['sotafl'] = True
                     else:
                         env['errno'].append(
                             (lc, pos+1, f"{ref} is invalid SOTA ref#."))
@@ -473,7 +722,7 @@ def compileFLE(input_text, conv_mode):
                         (id, ref, w) = tl[pos]
                         if id == 'potaref':
                             env['mypota'] += [ref]
-                            potafl = True
+                            env['potafl'] = True
                         else:
                             env['errno'].append(
                                 (lc, pos, f"{ref} is invalid POTA ref#."))
@@ -502,7 +751,7 @@ def compileFLE(input_text, conv_mode):
                         env['ctstnum'] = 1
                     else:
                         env['ctstlit'] = w.upper()
-                    ctstfl = True
+                    env['ctstfl'] = True
                 else:
                     env['errno'].append((lc, pos, 'Missing operand.'))
                 lc += 1
@@ -532,6 +781,7 @@ def compileFLE(input_text, conv_mode):
                 p2 = re.sub(r'\$mypota', ' '.join(env['mypota']), p2)
                 p2 = re.sub(r'\$mysota', env['mysota'], p2)
                 env['qslmsg'] = p2
+                compileQSLMsg(p2)
                 lc += 1
                 continue
             if key == 'date':
@@ -568,361 +818,155 @@ def compileFLE(input_text, conv_mode):
         else:
             length = len(tl)
             state = NORM
+            q = QSOLine()
             while pos < length:
-                (t, p1, p2) = tl[pos]
-                if t == 'comment':
-                    if p1 == '<':
-                        env['c_qso_msg'] = p2
-                    elif p1 == '{':
-                        env['c_qso_rmks'] = p2
-                    elif p1 == '[':
-                        env['c_qsl_msg'] = p2
-                    pos += 1
-                    continue
-                if state == NORM:
-                    if t == 'md':
-                        env['c_mode'] = p1
-                        state = NORM
-                        pos += 1
-                        continue
-                    if t == 'band':
-                        env['c_band'] = p2
-                        env['c_freq'] = band_to_freq(p2, True)
-                        state = FREQ
-                        pos += 1
-                        continue
-                    if t == 'dec':
-                        if p1 == 1:
-                            env['c_min'] = int(env['c_min']//10)*10 + int(p2)
-                        elif p1 == 2:
-                            env['c_min'] = int(p2) % 60
-                        elif p1 == 3:
-                            h = int(p2) // 100
-                            m = int(p2) % 60
-                            env['c_hour'] = int(env['c_hour']//10)*10 + h
-                            env['c_min'] = m
-                        elif p1 == 4:
-                            h = int(p2) // 100
-                            m = int(p2) % 100 % 60
-                            env['c_hour'] = h
-                            env['c_min'] = m
-                        else:
-                            env['errno'].append(
-                                (lc, pos, 'Wrong time format.'))
-                        pos += 1
-                        state = NORM
-                        continue
-                    if t == 'freq':
-                        env['c_freq'] = p2
-                        (f, _, b) = freq_to_band(p2)
-                        if f == 'Out of the band':
-                            env['errno'].append((lc, pos, 'Unknown band.'))
-                        env['c_band'] = b
-                        pos += 1
-                        state = NORM
-                        continue
-                    if t == 'wwffref':
-                        env['c_his_wwff'] = p1
-                        pos += 1
-                        state = NORM
-                        continue
-                    if t == 'potaref':
-                        env['c_his_pota'] += [p1]
-                        pos += 1
-                        state = NORM
-                        continue
-                    if t == 'sotaref':
-                        env['c_his_sota'] = p1
-                        pos += 1
-                        state = NORM
-                        continue
-                    if t == 'call':
-                        prev = env['c_call']
-                        if prev != '':
-                            env['errno'].append(
-                                (lc, pos, 'Each line must contains only one callsign: '+p1))
-                        if env['c_band'] == '' and env['c_freq'] == '':
-                            env['errno'].append(
-                                (lc, pos, 'Band or frequency must be specified before QSO.'))
-                        env['c_call'] = p1
-                        pos += 1
-                        qsoc += 1
-                        state = RSTS
-                        continue
-                    if t == 'ctstrcvd':
-                        env['c_my_num'] = p1.replace(',', '')
-                        if not env['c_his_num']:
-                            if env['ctstnum']:
-                                env['c_his_num'] = f"{env['ctstnum']:03}"
-                                env['ctstnum'] += 1
-                            elif env['ctstlit']:
-                                env['c_his_num'] = env['ctstlit']
-                        pos += 1
-                        state = NORM
-                        continue
-                    if t == 'ctstsent':
-                        s = p1.replace('.', '')
-                        if env['ctstnum']:
-                            try:
-                                num = int(s)
-                            except Exception as e:
-                                num = 1
-                            env['ctstnum'] = num + 1
-                            env['c_his_num'] = f"{num:03}"
-                        elif env['ctstlit']:
-                            env['c_his_num'] = s.upper()
-                        pos += 1
-                        state = NORM
-                        continue
-                    if t == 'literal':
-                        env['c_qso_msg'] = p2
-                        pos += 1
-                        if pos < length:
-                            (t, p1, p2) = tl[pos]
-                            if t == 'literal':
-                                env['c_qso_rmks'] = p2
-                                pos += 1
-                        state = NORM
-                        continue
-                    env['errno'].append((lc, pos, 'Unknown literal: '+p2))
-                    pos += 1
-                    state = NORM
-                    continue
-                elif state == FREQ:
-                    if t == 'freq':
-                        env['c_freq'] = p2
-                        (f, _, b) = freq_to_band(p2)
-                        if f == 'Out of the band':
-                            env['errno'].append((lc, pos, 'Out of the band.'))
-                        env['c_band'] = b
-                        pos+=1
-                        state = NORM
-                        continue
-                    else:
-                        state = NORM
-                        continue
-                elif state == RSTS:
-                    if t == 'dec':
-                        if p1 == 1:
-                            env['c_s_s'] = int(p2)
-                            pos += 1
-                            state = RSTR
-                            continue
-                        elif p1 == 2:
-                            env['c_r_s'] = int(p2)//10
-                            env['c_s_s'] = int(p2)%10
-                            pos += 1
-                            state = RSTR
-                            continue
-                        elif p1 == 3:
-                            env['c_r_s'] = int(p2)//100
-                            env['c_s_s'] = (int(p2)%100)//10
-                            env['c_t_s'] = int(p2)%10
-                            pos += 1
-                            state = RSTR
-                            continue
-                        else:
-                            env['errno'].append((lc,pos,'Wrong RST format.'))
-                            state = NORM
-                            continue
-                    elif t == 'snr':
-                        env['c_snr_s'] = p1
-                        pos += 1
-                        state = RSTR
-                        continue
-                    else:
-                        state = NORM
-                        continue
-                elif state == RSTR:
-                    state = NORM
-                    if t == 'dec':
-                        if p1 == 1:
-                            env['c_s_r'] = int(p2)
-                            pos += 1
-                            continue
-                        elif p1 == 2:
-                            env['c_r_r'] = int(p2)//10
-                            env['c_s_r'] = int(p2)%10
-                            pos += 1
-                            continue
-                        elif p1 == 3:
-                            env['c_r_r'] = int(p2)//100
-                            env['c_s_r'] = (int(p2)%100)//10
-                            env['c_t_r'] = int(p2)%10
-                            pos += 1
-                            continue
-                        else:
-                            env['errno'].append((lc,pos,'Wrong RST format.'))
-                    elif t == 'snr':
-                        env['c_snr_r'] = p1
-                        pos += 1
-                    continue
+                f = dispatch.get((state, tl[pos][0]))
+                if f is None:
+                    f = default[state]
+                (pos, state) = f(env, q, tl, pos, lc, state)
             lc+=1
-        if env['c_call'] != '':
-            if conv_mode : # GenerateLog
-                rt = modes_sig(env['c_mode'])
-                if rt == 'rst':
-                    rsts = '{}{}{}'.format(env['c_r_s'],env['c_s_s'],env['c_t_s'])
-                    rstr = '{}{}{}'.format(env['c_r_r'],env['c_s_r'],env['c_t_r'])
-                elif rt == 'rs':
-                    rsts = '{}{}'.format(env['c_r_s'],env['c_s_s'])
-                    rstr = '{}{}'.format(env['c_r_r'],env['c_s_r'])
-                elif rt == 'snr':
-                    rsts = env['c_snr_s']
-                    rstr = env['c_snr_r']
-
-                trans_tz(env)
-
-                if ctstfl and not env['c_my_num']:
-                    env['errno'].append((lc,pos,f"No Contest # from {env['c_call']}."))
-                    
-                qso = {
-                    'mycall': env['mycall'],
-                    'year':env['utc_year'],
-                    'month':env['utc_month'],
-                    'day':env['utc_day'],
-                    'hour':env['utc_hour'],
-                    'min':env['utc_min'],
-                    'callsign':env['c_call'],
-                    'band':env['c_band'],
-                    'freq':env['c_freq'],
-                    'mode':env['c_mode'],
-                    'rigset':env['c_rigset'],
-                    'rst_sent': rsts,
-                    'rst_rcvd': rstr,
-                    'his_num': env['c_his_num'],
-                    'my_num': env['c_my_num'],
-                    'mysota':env['mysota'],
-                    'hissota':env['c_his_sota'],
-                    'mywwff':env['mywwff'],
-                    'hiswwff':env['c_his_wwff'],
-                    'mypota':env['mypota'],
-                    'hispota':env['c_his_pota'],
-                    'operator':env['operator'],
-                    'qsomsg':env['c_qso_msg'],
-                    'qsormks':env['c_qso_rmks'],
-                    'qslmsg':env['qslmsg']
-                }
-                hamlogqso = []
-                (_, _, qth, qsl) = compose_qsl_msg(qso, env);
-                if len(qth)> 56: #28
-                    env['errno'].append((lc-2,pos,'QTH too long: ' + qth))
-                if len(qsl)> 54:
-                    env['errno'].append((lc-1,pos,'Remarks2 too long: ' + qsl))
-                
-            else: #Online
-                mycall = env['mycall']
-                call = env['c_call']
-
-                trans_tz(env)
-                date = '{y:02}-{m:02}-{d:02}'.format(y=env['utc_year'],m=env['utc_month'],d=env['utc_day'])
-                time = '{h:02}:{m:02}'.format(h=env['utc_hour'],m=env['utc_min'])
-
-                band = env['c_band']
-                mode = env['c_mode']
-                rt = modes_sig(mode)
-                if rt == 'rst':
-                    rsts = '{}{}{}'.format(env['c_r_s'],env['c_s_s'],env['c_t_s'])
-                    rstr = '{}{}{}'.format(env['c_r_r'],env['c_s_r'],env['c_t_r'])
-                elif rt == 'rs':
-                    rsts = '{}{}'.format(env['c_r_s'],env['c_s_s'])
-                    rstr = '{}{}'.format(env['c_r_r'],env['c_s_r'])
-                elif rt == 'snr':
-                    rsts = env['c_snr_s']
-                    rstr = env['c_snr_r']
-
-                if ctstfl:
-                    if env['c_his_num']:
-                        rsts += ' ' + env['c_his_num']
-
-                    if env['c_my_num']:
-                        rstr += ' ' + env['c_my_num']
-                    else:
-                        env['errno'].append((lc,pos,f"No Contest # from {env['c_call']}."))
-                    
-                qsotmp = {
-                    'mycall': env['mycall'],
-                    'year':env['utc_year'],
-                    'month':env['utc_month'],
-                    'day':env['utc_day'],
-                    'hour':env['utc_hour'],
-                    'min':env['utc_min'],
-                    'callsign':env['c_call'],
-                    'band':env['c_band'],
-                    'freq':env['c_freq'],
-                    'mode':env['c_mode'],
-                    'rigset':env['c_rigset'],
-                    'rst_sent': rsts,
-                    'rst_rcvd': rstr,
-                    'mysota':env['mysota'],
-                    'hissota':env['c_his_sota'],
-                    'mywwff':env['mywwff'],
-                    'hiswwff':env['c_his_wwff'],
-                    'mypota':env['mypota'],
-                    'hispota':env['c_his_pota'],
-                    'operator':env['operator'],
-                    'qsomsg':env['c_qso_msg'],
-                    'qsormks':env['c_qso_rmks'],
-                    'qslmsg':env['qslmsg']
-                }
-                (rmks, freq, qth, qsl) = compose_qsl_msg(qsotmp, env);
-                if len(qth)> 56: #28
-                    env['errno'].append((lc-2,pos,'QTH too long: ' + qth))
-                if len(qsl)> 54:
-                    env['errno'].append((lc-1,pos,'Remarks2 too long: ' + qsl))
-                    
-                mysota = env['mysota']
-                hissota = env['c_his_sota']
-                myref = ''
-                hisref =''
-                if potafl:
-                    myref = '/'.join(env['mypota'])
-                    hisref = '/'.join(env['c_his_pota'])
-                    prefix = '/'
-                else:
-                    prefix = ''
-                    
-                if wwfffl:
-                    myref += prefix + env['mywwff']
-                    if env['c_his_wwff'] != '':
-                        hisref += prefix + env['c_his_wwff']
-
-                if hissota:
-                    topref = 'S2S'
-                else:
-                    topref = ''
+        if q and q.call != '':
+            rt = modes_sig(env['c_mode'])
+            if rt == 'rst':
+                rsts = '{}{}{}'.format(q.r_s,q.s_s,q.t_s)
+                rstr = '{}{}{}'.format(q.r_r,q.s_r,q.t_r)
+            elif rt == 'rs':
+                rsts = '{}{}'.format(q.r_s,q.s_s)
+                rstr = '{}{}'.format(q.r_r,q.s_r)
+            elif rt == 'snr':
+                rsts = q.snr_s
+                rstr = q.snr_r
+
+            trans_tz(env)
+
+            if env['ctstfl'] and not q.my_num:
+                env['errno'].append((lc,pos,f"No Contest # from {q.call}."))
+
+            qso = {
+                'qsoc': env['qsoc'],
+                'mycall': env['mycall'],
+                'year':env['utc_year'],
+                'month':env['utc_month'],
+                'day':env['utc_day'],
+                'hour':env['utc_hour'],
+                'min':env['utc_min'],
+                'callsign':q.call,
+                'band':env['c_band'],
+                'freq':env['c_freq'],
+                'mode':env['c_mode'],
+                'rigset':env['c_rigset'],
+                'rst_sent': rsts,
+                'rst_rcvd': rstr,
+                'his_num': q.his_num,
+                'my_num': q.my_num,
+                'mysota':env['mysota'],
+                'hissota':q.his_sota,
+                'mywwff':env['mywwff'],
+                'hiswwff':q.his_wwff,
+                'mypota':env['mypota'],
+                'hispota':q.his_pota,
+                'operator':env['operator'],
+                'qsomsg':q.qso_msg,
+                'qsormks':q.qso_rmks,
+                'qslmsg':env['qslmsg']
+            }
+            qso['composed'] = compose_qsl_msg(qso, env)
+            (_, _, qth, qsl) = qso['composed']
+            if len(qth)> 56: #28
+                env['errno'].append((lc-2,pos,'QTH too long: ' + qth))
+            if len(qsl)> 54:
+                env['errno'].append((lc-1,pos,'Remarks2 too long: ' + qsl))
+
+            while nerr < len(errors):
+                yield ('error', errors[nerr])
+                nerr += 1
+            yield ('qso', qso)
+
+    while nerr < len(errors):
+        yield ('error', errors[nerr])
+        nerr += 1
+
+
+def qsoRecords(stream):
+    # iterFLE のイベント列、またはQSOレコード列からQSOだけを取り出す
+    for r in stream:
+        if isinstance(r, tuple):
+            if r[0] == 'qso':
+                yield r[1]
+        else:
+            yield r
 
-                if hisref:
-                    if topref:
-                        topref +='/P2P'
-                    else:
-                        topref = 'P2P'
-                        
-                qsormks = get_ref(env['c_qso_rmks'])
-                operator = env['operator']
-                hisname = env['c_qso_msg']
 
-                qso = [ str(qsoc), mycall, date, time, call, band, mode, rsts, rstr, mysota, hissota, myref, hisref, qsormks['LOC']+qsormks['SAT'], operator]
-                hamlogqso = [ str(qsoc), call, date, time+'U', rsts, rstr, freq, mode, rmks['LOC_org'], hisname, qth, qsl]
+def toInterpFLE(h, env):
+    date = '{y:02}-{m:02}-{d:02}'.format(y=h['year'],m=h['month'],d=h['day'])
+    time = '{h:02}:{m:02}'.format(h=h['hour'],m=h['min'])
+
+    rsts = h['rst_sent']
+    rstr = h['rst_rcvd']
+    if env['ctstfl']:
+        if h['his_num']:
+            rsts += ' ' + h['his_num']
+        if h['my_num']:
+            rstr += ' ' + h['my_num']
 
+    (rmks, freq, qth, qsl) = h['composed']
+
+    myref = ''
+    hisref =''
+    if env['potafl']:
+        myref = '/'.join(h['mypota'])
+        hisref = '/'.join(h['hispota'])
+        prefix = '/'
+    else:
+        prefix = ''
+
+    if env['wwfffl']:
+        myref += prefix + h['mywwff']
+        if h['hiswwff'] != '':
+            hisref += prefix + h['hiswwff']
+
+    qsoc = str(h['qsoc'])
+    call = h['callsign']
+    qso = [ qsoc, h['mycall'], date, time, call, h['band'], h['mode'], rsts, rstr, h['mysota'], h['hissota'], myref, hisref, rmks['LOC']+rmks['SAT'], h['operator']]
+    hamlogqso = [ qsoc, call, date, time+'U', rsts, rstr, freq, h['mode'], rmks['LOC_org'], h['qsomsg'], qth, qsl]
+    return (qso, hamlogqso)
+
+
+def buildFLE(input_text, conv_mode, store_input=False, sort_qso=False, parsed=None):
+    if parsed is None:
+        parsed = parseFLE(input_text)
+    (records, env) = parsed
+    res = []
+    hamlogres = []
+
+    # 変換モードはレコードをそのままパイプラインに流す
+    if not conv_mode:
+        for h in records:
+            (qso, hamlogqso) = toInterpFLE(h, env)
             res.append(qso)
             hamlogres.append(hamlogqso)
 
+    sotafl = env['sotafl']
+    wwfffl = env['wwfffl']
+    potafl = env['potafl']
+    ctstfl = env['ctstfl']
+
     if conv_mode:
         if len(env['errno'])>0:
             now  = datetime.datetime.now()
             logname= now.strftime("%Y-%m-%d-%H-%M")
-            err_log = "####FLE Interpretation Error####\n"
-            errors = env['errno']
+            err_log = ["####FLE Interpretation Error####\n"]
+            errors = indexErrors(env['errno'])
             lines = input_text.splitlines()
             lc = 0
             for l in lines:
-                e = findErrors(lc,errors)
+                e = errors.get(lc)
                 if e:
-                    err_log = err_log + l + " #--- Error! "+ e + "\n"
+                    err_log.append(l + " #--- Error! "+ "; ".join(e) + "\n")
                 else:
-                    err_log = err_log + l + "\n"
+                    err_log.append(l + "\n")
                 lc += 1
+            err_log = ''.join(err_log)
             files = {
                 "fle-error-" + logname + ".txt" : err_log
             }
@@ -933,42 +977,50 @@ def compileFLE(input_text, conv_mode):
             fname = "fle-" + now.strftime("%Y-%m-%d-%H-%M")
             aday = '{}{:02}{:02}'.format(env['year'],env['month'],env['day'])
             logname= aday + '@' + env['mysota'].replace('/','-')+'-'.join(env['mypota'])+env['mywwff']
-            files = {
-                "fle-" + logname + ".txt" :input_text,
-                "hamlog-" + logname + ".csv" : sendHamlog_FLE(res,env),
-                "airham-" + logname + ".csv" : sendAirHam_FLE(res,env)
-            }
-            
+            inname = "fle-" + logname + ".txt"
+            # 入力テキストはユーザー自身のものなので無圧縮でもよい
+            files = ZipStream(level=zipLevel(len(input_text)),
+                              store=(inname,) if store_input else ())
+            files[inname] = input_text
+
+            pipe = FLEPipeline(ordered=sort_qso)
+            pipe.register(HamlogFLEWriter("hamlog-" + logname + ".csv", env))
+            pipe.register(AirHamFLEWriter("airham-" + logname + ".csv", env))
+
             if sotafl:
-                files = sendSOTA_FLE(files,res)
+                pipe.register(SOTAFLEWriter())
 
             if wwfffl:
-                files = sendADIF_FLE(files, res, env['mycall'], 'WWFF', env['mywwff'])
+                pipe.register(ADIFFLEWriter(env['mycall'], 'WWFF', env['mywwff']))
 
             if potafl:
-                for mysiginfo in env['mypota']:
-                    files = sendADIF_FLE(files, res, env['mycall'], 'POTA', mysiginfo)
+                # 同じ参照番号が重複したら1つのファイルにまとめる
+                for (mysiginfo, copies) in countRefs(env['mypota']).items():
+                    pipe.register(ADIFFLEWriter(env['mycall'], 'POTA', mysiginfo, copies))
 
             if (not sotafl) and (not wwfffl) and (not potafl):
-                files = sendSOTA_FLE(files,res)
+                pipe.register(SOTAFLEWriter())
 
             if ctstfl:
-                files = sendZLOG_FLE(files,res)
+                pipe.register(ZLOGFLEWriter())
+
+            pipe.run(records, files)
             
             #print (files)
-            return writeZIP(files)
+            return files.getvalue()
     else:
         if len(env['errno'])>0:
             status ='ERR'
             logtype = 'NONE'
-            errors = env['errno']
+            errors = indexErrors(env['errno'])
             lines = input_text.splitlines()
             lc = 0
             res = []
             hamglogres = []
             for l in lines:
-                e = findErrors(lc,errors)
+                e = errors.get(lc)
                 if e:
+                    e = "; ".join(e)
                     res.append([str(lc),e, l])
                     hamlogres.append([str(lc),e, l])
                 else:
@@ -1002,238 +1054,308 @@ def compileFLE(input_text, conv_mode):
         }
         return (res)
     
-def findErrors(lc,err):
-    for e in err:
-        (l,c,msg) = e
-        if lc == l:
-            return msg
-    return None
+def indexErrors(err):
+    # 行番号 -> エラーメッセージのリスト
+    idx = {}
+    for (l,c,msg) in err:
+        if l in idx:
+            idx[l].append(msg)
+        else:
+            idx[l] = [msg]
+    return idx
+
+class FLEPipeline:
+    # 登録したライタ全てにQSOを1回の走査で配る。
+    # ordered なら時刻順に並べ替えてから配る
+    def __init__(self, writers=None, ordered=False):
+        self.writers = list(writers or [])
+        self.ordered = ordered
+
+    def register(self, writer):
+        self.writers.append(writer)
+        return writer
+
+    def run(self, loginput, files):
+        writers = self.writers
+        for w in writers:
+            w.begin(files, self.ordered)
+        records = qsoRecords(loginput)
+        if self.ordered:
+            records = externalSort(records, fleKey)
+        for h in records:
+            deriveFLE(h)
+            for w in writers:
+                w.write(h)
+        for w in writers:
+            w.close(files)
+        if any(w.truncated for w in writers):
+            reportTruncated(files, lineLimit(files))
+        return files
+
+
+def fleKey(h):
+    return (h['year'], h['month'], h['day'], h['hour'], h['min'])
+
+
+def deriveFLE(h):
+    # 各ライタで共通に使う派生フィールド
+    if 'composed' not in h:
+        h['composed'] = compose_qsl_msg(h, None)
+    h['date2'] = '{year:02}{month:02}{day:02}'.format(
+        day=h['day'], month=h['month'], year=h['year'])
+    h['time2'] = '{hour:02}{minute:02}'.format(hour=h['hour'], minute=h['min'])
+    h['freq_sota'] = band_to_freq(h['band'], is_sota=True)
+    h['freq_air'] = band_to_freq(h['band'])
+    h['mode_sota'] = mode_to_SOTAmode(h['mode'])
+    h['mode_adif'] = mode_to_ADIFmode(h['mode'])
+    return h
+
 
 def toSOTAFLE(h):
     date = '{day:02}/{month:02}/{year:02}'.format(
         day=h['day'], month=h['month'], year=h['year'])
 
-    date2 = '{year:02}{month:02}{day:02}'.format(
-        day=h['day'], month=h['month'], year=h['year'])
-
-    f =band_to_freq(h['band'],is_sota = True)
-    rmks = get_ref(h['qsormks'])
+    rmks = h['composed'][0]
     l = [
         "V2",
         h['mycall'],
         h['mysota'],
         date,
         '{hour:02}:{minute:02}'.format(hour=h['hour'], minute=h['min']),
-        f,
-        mode_to_SOTAmode(h['mode']),
+        h['freq_sota'],
+        h['mode_sota'],
         h['callsign'],
         h['hissota'],
         rmks['LOC']+rmks['SAT']
     ]
-    return (date2,h['mysota']!=''and h['hissota']!='',l)
+    return (h['date2'],h['mysota']!=''and h['hissota']!='',l)
+
+class SOTAFLEWriter:
+    def __init__(self):
+        self.prefix = 'sota'
+        self.prefix2 = 'sota-s2s-'
+        self.linecount = 0
+        self.truncated = False
+
+    def begin(self, files, ordered=False):
+        # 日付ごと(とS2S)に出力を分ける。時刻順なら日付が変わったら閉じる
+        self.out = PartitionedCSV(files, delimiter=',', quoting=csv.QUOTE_MINIMAL)
+        self.ordered = ordered
+        self.fname = None
+        self.empty = True
+        self.limit = lineLimit(files)
+
+    def write(self, row):
+        if overLimit(self.linecount, self.limit):
+            self.truncated = True
+            return
+        (fn,s2s,l) = toSOTAFLE(row)
+        if self.ordered and fn != self.fname:
+            self.out.close()
+            self.fname = fn
+        self.empty = False
+        self.out.writerow(self.prefix + fn + '.csv', l)
+        if s2s:
+            self.out.writerow(self.prefix2 + fn + '.csv', l)
+        self.linecount += 1
+
+    def close(self, files):
+        if self.empty:
+            # QSOがなくても空のファイルを出す
+            files[self.prefix + '.csv'] = ''
+        self.out.close()
 
 def sendSOTA_FLE(files, loginput):
-    prefix = 'sota'
-    prefix2 = 'sota-s2s-'
-    fname = ''
-    linecount = 0
-
-    outstr = io.StringIO()
-    writer = csv.writer(outstr,delimiter=',',
-                        quoting=csv.QUOTE_MINIMAL)
-    outstr_s2s = io.StringIO()
-    writer_s2s = csv.writer(outstr_s2s,delimiter=',',
-                            quoting=csv.QUOTE_MINIMAL)
-
-    for row in loginput:
-        if linecount > 100000:
-            break
-        else:
-            (fn,s2s,l) = toSOTAFLE(row)
-            if linecount == 0:
-                fname = fn
-                
-            if fn == fname:
-                writer.writerow(l)
-                if s2s:
-                    writer_s2s.writerow(l)
-                linecount += 1
-            else:
-                name = prefix + fname + '.csv'
-                files.update({name : outstr.getvalue()})
-
-                s2sbuff = outstr_s2s.getvalue()
-                if len(s2sbuff) >0:
-                    name2 = prefix2 + fname + '.csv'
-                    files.update({name2 : s2sbuff})
-                        
-                outstr = io.StringIO()
-                writer = csv.writer(outstr,delimiter=',',
-                                        quoting=csv.QUOTE_MINIMAL)
-                writer.writerow(l)
-
-                outstr_s2s = io.StringIO()
-                writer_s2s = csv.writer(outstr_s2s,delimiter=',',
-                                        quoting=csv.QUOTE_MINIMAL)
-                if s2s:
-                    writer_s2s.writerow(l)
-                fname = fn
-
-    name = prefix + fname + '.csv'
-    files.update({name : outstr.getvalue()})
-
-    s2sbuff = outstr_s2s.getvalue()
-    if len(s2sbuff) >0:
-        name2 = prefix2 + fname + '.csv'
-        files.update({name2 : s2sbuff})
-
-    return(files)
+    return FLEPipeline([SOTAFLEWriter()]).run(loginput, files)
 
 def toADIF_FLE(h, mysig, mysiginfo, hissigl):
-    date = '{year:02}{month:02}{day:02}'.format(
-        day=h['day'], month=h['month'], year=h['year'])
+    date = h['date2']
 
-    (mode, smode) = mode_to_ADIFmode(h['mode'])
+    (mode, smode) = h['mode_adif']
     if hissigl:
         l = []
         for hissig in hissigl:
             l += [[
-                adif('activator',h['mycall']),
-                adif('callsign',h['callsign']),
-                adif('date',date),
-                adif('time',
-                     '{hour:02}{minute:02}'.format(
-                         hour=h['hour'], minute=h['min'])),
-                adif('band-wlen',h['band']),
-                adif('mode', mode),
-                adif('rst_sent',h['rst_sent']),
-                adif('rst_rcvd',h['rst_rcvd']),
-                adif('mysig',mysig),
-                adif('mysiginfo',mysiginfo),
-                adif('sig',mysig),adif('siginfo', hissig),
-                adif('operator',h['operator']),'<EOR>']]       
+                ('activator',h['mycall']),
+                ('callsign',h['callsign']),
+                ('date',date),
+                ('time',h['time2']),
+                ('band-wlen',h['band']),
+                ('mode', mode),
+                ('rst_sent',h['rst_sent']),
+                ('rst_rcvd',h['rst_rcvd']),
+                ('mysig',mysig),
+                ('mysiginfo',mysiginfo),
+                ('sig',mysig),('siginfo', hissig),
+                ('operator',h['operator']),'<EOR>']]       
     else:
         l = [
-            [adif('activator',h['mycall']),
-            adif('callsign',h['callsign']),
-            adif('date',date),
-            adif('time',
-                 '{hour:02}{minute:02}'.format(
-                     hour=h['hour'], minute=h['min'])),
-            adif('band-wlen',h['band']),
-            adif('mode', mode),
-            adif('rst_sent',h['rst_sent']),
-            adif('rst_rcvd',h['rst_rcvd']),
-            adif('mysig',mysig),
-            adif('mysiginfo',mysiginfo),
-            adif('operator',h['operator']),'<EOR>']]       
+            [('activator',h['mycall']),
+            ('callsign',h['callsign']),
+            ('date',date),
+            ('time',h['time2']),
+            ('band-wlen',h['band']),
+            ('mode', mode),
+            ('rst_sent',h['rst_sent']),
+            ('rst_rcvd',h['rst_rcvd']),
+            ('mysig',mysig),
+            ('mysiginfo',mysiginfo),
+            ('operator',h['operator']),'<EOR>']]       
     
     return (date, l)
 
-def sendADIF_FLE(files, loginput, callsign, mysig, mysiginfo):
-    outstr = io.StringIO()
-    linecount = 0
-    fname = ''
-    writer = csv.writer(outstr, delimiter=' ',
-                        quoting=csv.QUOTE_MINIMAL)
-    header = 'ADIF Export from HAMLOG by JL1NIE\n' + adif('programid','FCTH')+ '\n' + adif('adifver','3.1.4')+'\n' + '<EOH>\n'
+def countRefs(refs):
+    counts = {}
+    for ref in refs:
+        counts[ref] = counts.get(ref, 0) + 1
+    return counts
 
-    date = ''
+class ADIFFLEWriter:
+    header = 'ADIF Export from HAMLOG by JL1NIE\n' + adif('programid','FCTH')+ '\n' + adif('adifver','3.1.4')+'\n' + '<EOH>\n'
 
-    for row in loginput:
-        if linecount > 100000:
-            break
+    def __init__(self, callsign, mysig, mysiginfo, copies=1):
+        self.callsign = callsign
+        self.mysig = mysig
+        self.mysiginfo = mysiginfo
+        self.copies = copies
+        self.linecount = 0
+        self.truncated = False
+        self.fname = ''
+        self.date = ''
+        self.outstr = None
+
+    def begin(self, files, ordered=False):
+        self.files = files
+        self.limit = lineLimit(files)
+
+    def newBuffer(self):
+        # ストリーム出力ならZIPへ直接、dict なら close でまとめて追記する
+        # 重複した参照番号は同じ内容を繰り返すので close でまとめて書く
+        if isStream(self.files) and self.copies == 1:
+            self.outstr = self.files.open(self.fname)
+            self.outstr.write(self.header)
         else:
-            if mysig == 'POTA':
-                (d, l) = toADIF_FLE(row, mysig, mysiginfo, row['hispota'])
-            elif mysig == 'WWFF':
-                (d, l) = toADIF_FLE(row, mysig, mysiginfo, row['hiswwff'])
-                
-            if not date:
-                date = d
-                
-            fn = callsign.replace('/','-') + '@' + mysiginfo + '-'+ date +'.adi'
-                
-            if linecount == 0:
-                fname = fn
-
-            if fn == fname:
-                for r in l:
-                    writer.writerow(r)
-            else:
-                if fname in files:
-                    newstr = files[fname] + outstr.getvalue()
-                else:
-                    newstr = header + outstr.getvalue()
-
-                files.update({fname : newstr })
-                outstr = io.StringIO()
-                writer = csv.writer(outstr,delimiter=' ',
-                                    quoting=csv.QUOTE_MINIMAL)
-                fname = fn
-                for r in l:
-                    writer.writerow(r)
-                    
-        linecount += 1
-
-    if fname != '':
-        if fname in files:
-            newstr = files[fname] + outstr.getvalue()
+            self.outstr = io.StringIO()
+        self.writer = ADIFWriter(self.outstr)
+
+    def write(self, row):
+        if overLimit(self.linecount, self.limit):
+            self.truncated = True
+            return
+        if self.mysig == 'POTA':
+            (d, l) = toADIF_FLE(row, self.mysig, self.mysiginfo, row['hispota'])
+        elif self.mysig == 'WWFF':
+            (d, l) = toADIF_FLE(row, self.mysig, self.mysiginfo, row['hiswwff'])
+
+        if not self.date:
+            self.date = d
+
+        # 日付は最初のQSOで固定なので出力ファイルは1つ
+        if self.linecount == 0:
+            self.fname = self.callsign.replace('/','-') + '@' + self.mysiginfo + '-'+ self.date +'.adi'
+            self.newBuffer()
+
+        for r in l:
+            self.writer.writerow(r)
+
+        self.linecount += 1
+
+    def close(self, files):
+        if not self.outstr:
+            return
+        if isStream(files) and self.copies == 1:
+            self.outstr.close()
+            return
+        body = self.outstr.getvalue() * self.copies
+        if self.fname in files and not isStream(files):
+            files[self.fname] += body
         else:
-            newstr = header + outstr.getvalue()
-        files.update({fname : newstr })
+            files[self.fname] = self.header + body
 
-    return files
+def sendADIF_FLE(files, loginput, callsign, mysig, mysiginfo):
+    return FLEPipeline([ADIFFLEWriter(callsign, mysig, mysiginfo)]).run(loginput, files)
 
-def sendZLOG_FLE(files, loginput):
-    outstr = io.StringIO()
-    linecount = 0
-    fname = ''
-    writer = csv.writer(outstr, delimiter='\t',
-                        quoting=csv.QUOTE_MINIMAL)
+class ZLOGFLEWriter:
     header = ['DATE','TIME','BAND','MODE','CALLSIGN','SENTNo','RCVNo']
-    date = ''
 
-    for h in loginput:
-        if linecount > 100000:
-            break
+    def __init__(self):
+        self.outstr = None
+        self.linecount = 0
+        self.truncated = False
+        self.fname = ''
+        self.date = ''
+
+    def begin(self, files, ordered=False):
+        self.files = files
+        self.limit = lineLimit(files)
+
+    def write(self, h):
+        if overLimit(self.linecount, self.limit):
+            self.truncated = True
+            return
+        l = [
+            f"{h['year']}-{h['month']}-{h['day']}",
+            f"{h['hour']:02}:{h['min']:02}",
+            h['freq'].replace('MHz',''),
+            h['mode'],
+            h['callsign'],
+            h['rst_sent'],
+            h['his_num'],
+            h['rst_rcvd'],
+            h['my_num']]
+
+        if not self.date:
+            self.date = h['date2']
+
+        fn = 'contest-'+ self.date +'.txt'
+
+        if self.linecount == 0:
+            self.fname = fn
+            self.outstr = openOutput(self.files, self.fname)
+            self.writer = csv.writer(self.outstr, delimiter='\t',
+                                     quoting=csv.QUOTE_MINIMAL)
+            self.writer.writerow(self.header)
+        self.writer.writerow(l)
+
+        self.linecount += 1
+
+    def close(self, files):
+        if self.outstr:
+            self.outstr.close()
         else:
-            d = '{year:02}{month:02}{day:02}'.format(
-                day=h['day'], month=h['month'], year=h['year'])
-
-            l = [
-                f"{h['year']}-{h['month']}-{h['day']}",
-                f"{h['hour']:02}:{h['min']:02}",
-                h['freq'].replace('MHz',''),
-                h['mode'],
-                h['callsign'],
-                h['rst_sent'],
-                h['his_num'],
-                h['rst_rcvd'],
-                h['my_num']]
-
-
-            if not date:
-                date = d
-                
-            fn = 'contest-'+ date +'.txt'
-                
-            if linecount == 0:
-                writer.writerow(header)
-                fname = fn
-            writer.writerow(l)
-
-        linecount += 1
-
-    files.update({fname : outstr.getvalue()})
-    return files
+            files[self.fname] = ''
+
+def sendZLOG_FLE(files, loginput):
+    return FLEPipeline([ZLOGFLEWriter()]).run(loginput, files)
+
+class QSLTemplate:
+    # qslmsg の $sat / $rig を事前に展開しておく
+    def __init__(self, template):
+        plain = template.replace('$sat','')
+        self.plain_rig = '$rig' in plain
+        self.plain = plain.replace('$rig','')
+        parts = template.split('$sat')
+        self.sat_rig = any('$rig' in p for p in parts)
+        self.sat_parts = [p.replace('$rig','') for p in parts]
+
+    def format(self, sat_oscar):
+        if sat_oscar != '':
+            return (('via '+sat_oscar).join(self.sat_parts), self.sat_rig)
+        else:
+            return (self.plain, self.plain_rig)
+
+
+@functools.lru_cache(maxsize=256)
+def compileQSLMsg(template):
+    return QSLTemplate(template)
+
 
 def compose_qsl_msg(h,env):
 
     if h['freq'] != '':
-        f = re.sub(r'MHz','',h['freq'])
+        f = h['freq'].replace('MHz','')
     else:
-        f = re.sub(r'MHz','',band_to_freq(h['band']))
+        f = band_to_freq(h['band']).replace('MHz','')
 
     hisref = []
     if h['hissota'] != '':
@@ -1247,19 +1369,16 @@ def compose_qsl_msg(h,env):
     
     rmks = get_ref(h['qsormks'])
 
-    qslmsg = h['qslmsg']
+    (qslmsg, use_rig) = compileQSLMsg(h['qslmsg']).format(rmks['SAT_oscar'])
 
     if rmks['SAT_oscar'] != '':
-        qslmsg = qslmsg.replace('$sat','via '+rmks['SAT_oscar'])
         antsat='STS'
     else:
-        qslmsg = qslmsg.replace('$sat','')
         antsat='ST'
     if rmks['SAT_down'] != '':
-        f = f + '/' + re.sub(r'MHz', '',rmks['SAT_down'])
+        f = f + '/' + rmks['SAT_down'].replace('MHz', '')
         
-    if '$rig' in qslmsg:
-        qslmsg = qslmsg.replace('$rig','')    
+    if use_rig:
         rig = 'Rig='+ h['band'] + antsat
         if h['rigset'] > 0:
             rig = rig + str(h['rigset'])
@@ -1277,8 +1396,7 @@ def toHamlog_FLE(h,env):
     date = '{year:02}/{month:02}/{day:02}'.format(
         day=h['day'], month=h['month'], year=h['year']%100)
 
-
-    (rmks ,f , qthstr, qslmsg) = compose_qsl_msg(h, env)
+    (rmks ,f , qthstr, qslmsg) = h['composed']
         
     l = [
         h['callsign'],
@@ -1300,23 +1418,33 @@ def toHamlog_FLE(h,env):
     
     return (l)
 
-def sendHamlog_FLE(loginput, env):
-    raw = io.BytesIO()
-    outstr =io.TextIOWrapper(io.BufferedWriter(raw),
-                             encoding='cp932',errors="backslashreplace")
-    linecount = 0
-    writer = csv.writer(outstr, delimiter=',',
-                        quoting=csv.QUOTE_NONNUMERIC)
-    for row in loginput:
-        if linecount > 100000:
-            break
-        else:
-            l = toHamlog_FLE(row, env)
-            writer.writerow(l)
-            linecount += 1
+class HamlogFLEWriter:
+    def __init__(self, fname, env):
+        self.fname = fname
+        self.env = env
+        self.linecount = 0
+        self.truncated = False
+
+    def begin(self, files, ordered=False):
+        self.outstr = openOutput(files, self.fname,
+                                 encoding='cp932', errors="backslashreplace")
+        self.writer = csv.writer(self.outstr, delimiter=',',
+                                 quoting=csv.QUOTE_NONNUMERIC)
+        self.limit = lineLimit(files)
+
+    def write(self, row):
+        if overLimit(self.linecount, self.limit):
+            self.truncated = True
+            return
+        self.writer.writerow(toHamlog_FLE(row, self.env))
+        self.linecount += 1
+
+    def close(self, files):
+        self.outstr.close()
 
-    outstr.flush()
-    return (raw.getvalue())
+def sendHamlog_FLE(loginput, env):
+    files = FLEPipeline([HamlogFLEWriter('hamlog', env)]).run(loginput, {})
+    return files['hamlog']
 
 def toAirHamFLE(lcount, h, env):
     if lcount == 0:
@@ -1328,12 +1456,11 @@ def toAirHamFLE(lcount, h, env):
 
     tstr ="{year:04}/{month:02}/{day:02} {hour:02}:{min:02} +0000".format(year=h['year'],month=h['month'],day=h['day'],hour=h['hour'],min=h['min'])
     atime = datetime.datetime.strptime(tstr,'%Y/%m/%d %H:%M %z')
-    utime = atime.astimezone(datetime.timezone(datetime.timedelta(hours=0)))
     isotime = atime.isoformat()
     
     (operator, portable) = splitCallsign(h['callsign'])
     
-    freq = band_to_freq(h['band'])
+    freq = h['freq_air']
     freq_dec = re.sub(r'[MHz|KHz|GHz]','',freq)
     mode = mode_to_airhammode(h['mode'], freq_dec)
 
@@ -1363,25 +1490,36 @@ def toAirHamFLE(lcount, h, env):
         ]
     return l
 
+class AirHamFLEWriter:
+    def __init__(self, fname, env):
+        self.fname = fname
+        self.env = env
+        self.linecount = 0
+        self.truncated = False
+
+    def begin(self, files, ordered=False):
+        self.outstr = openOutput(files, self.fname,
+                                 encoding='utf-8', errors="backslashreplace")
+        self.writer = csv.writer(self.outstr, delimiter=',',
+                                 quoting=csv.QUOTE_MINIMAL)
+        self.limit = lineLimit(files)
+
+    def write(self, row):
+        if overLimit(self.linecount, self.limit):
+            self.truncated = True
+            return
+        if self.linecount == 0:
+            self.writer.writerow(toAirHamFLE(self.linecount, row, self.env))
+            self.linecount += 1
+        self.writer.writerow(toAirHamFLE(self.linecount, row, self.env))
+        self.linecount += 1
+
+    def close(self, files):
+        self.outstr.close()
+
 def sendAirHam_FLE(loginput, env):
-    raw = io.BytesIO()
-    outstr =io.TextIOWrapper(io.BufferedWriter(raw),
-                             encoding='utf-8',errors="backslashreplace")
-    linecount = 0
-    writer = csv.writer(outstr, delimiter=',',
-                        quoting=csv.QUOTE_MINIMAL)
-    for row in loginput:
-        if linecount > 100000:
-            break
-        else:
-            if linecount == 0:
-                writer.writerow(toAirHamFLE(linecount, row, env))
-                linecount += 1
-            writer.writerow(toAirHamFLE(linecount, row, env))
-            linecount += 1
-
-    outstr.flush()
-    return (raw.getvalue())
+    files = FLEPipeline([AirHamFLEWriter('airham', env)]).run(loginput, {})
+    return files['airham']
 
 def do_command(command, arg):
     res = {'status': "None" }
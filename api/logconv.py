@@ -1,25 +1,174 @@
 from http.server import BaseHTTPRequestHandler
+import contextlib
+import cProfile
 import datetime
+import hashlib
+import hmac
 import json
 import logging
+import os
+import pstats
+import shutil
+import time
 from api.convutil import (
     sendSOTA_A,
     sendSOTA_C,
     sendADIF,
+    checkADIF,
     sendAirHamLog,
     decodeHamlog,
-    writeZIP,
+    potaloc_stats,
+    zip_stats,
+    ZipStream,
+    zipLevel,
+    ZIP_CHUNK,
 )
-from api.fleonline import do_command, compileFLE
-from api.wspr import WSPRspots
+from api.fleonline import do_command, compileFLE, fle_cache, tokenizer
+from api.wspr import WSPRspots, WSPRstats
 import cgi
 import io
 
 logger = logging.getLogger("Hamlogconv")
 logging.basicConfig(level=logging.ERROR)
 
+# プロファイル結果は ERROR 以外でも出す
+profile_logger = logging.getLogger("Hamlogconv.profile")
+profile_logger.setLevel(logging.INFO)
+# リクエストごとのメトリクス(1行JSON)
+metrics_logger = logging.getLogger("Hamlogconv.metrics")
+metrics_logger.setLevel(logging.INFO)
+
+# LOGCONV_PROFILE=1 で全リクエスト、または LOGCONV_PROFILE_KEY で署名した
+# ヘッダ "X-Logconv-Profile: <unixtime>:<hmac-sha256(key, '<unixtime>:<path>')>"
+# を付けたリクエストだけプロファイルする
+PROFILE_ENV = "LOGCONV_PROFILE"
+PROFILE_KEY_ENV = "LOGCONV_PROFILE_KEY"
+PROFILE_DIR_ENV = "LOGCONV_PROFILE_DIR"
+PROFILE_HEADER = "X-Logconv-Profile"
+PROFILE_WINDOW = 300
+PROFILE_TOP = 25
+
+
+class Phases:
+    # フェーズ別の経過時間。入れ子のフェーズは外側から差し引く
+    def __init__(self):
+        self.times = {}
+        self.stack = []
+
+    @contextlib.contextmanager
+    def __call__(self, name):
+        start = time.perf_counter()
+        self.stack.append(0.0)
+        try:
+            yield
+        finally:
+            inner = self.stack.pop()
+            elapsed = time.perf_counter() - start
+            self.add(name, elapsed - inner)
+            if self.stack:
+                self.stack[-1] += elapsed
+
+    def add(self, name, t):
+        self.times[name] = self.times.get(name, 0.0) + t
+
+    def wrap(self, name, func):
+        def timed(*args, **kwargs):
+            with self(name):
+                return func(*args, **kwargs)
+        return timed
+
+    def split(self, name, parent, t):
+        # parent の時間のうち t 秒を name に付け替える(parent より長くはしない)
+        if t > 0 and parent in self.times:
+            t = min(t, self.times[parent])
+            self.times[parent] -= t
+            self.add(name, t)
+
+    def ms(self):
+        return {k: round(v * 1000, 3) for (k, v) in self.times.items()}
+
+    def header(self):
+        return ', '.join(f"{k};dur={v * 1000:.3f}" for (k, v) in self.times.items())
+
+
+class CountingReader(io.RawIOBase):
+    # 読み込んだバイト数と行数を数える
+    def __init__(self, fp):
+        self.fp = fp
+        self.nbytes = 0
+        self.nlines = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        data = self.fp.read(len(b))
+        n = len(data)
+        b[:n] = data
+        self.nbytes += n
+        self.nlines += data.count(b'\n')
+        return n
+
+
+def cacheCounters():
+    f = fle_cache.stats()
+    t = tokenizer.cache_info()
+    return {
+        'fle': (f['hits'], f['misses']),
+        'tokenizer': (t.hits, t.misses),
+        'potaloc': (potaloc_stats['hits'], potaloc_stats['misses']),
+    }
+
+
+def isChecked(form, name):
+    return form.getvalue(name, "") in ("1", "true", "on")
+
+
+def profileSignature(key, ts, path):
+    msg = f"{ts}:{path}".encode('utf-8')
+    return hmac.new(key.encode('utf-8'), msg, hashlib.sha256).hexdigest()
+
+
+def topFunctions(prof, n=PROFILE_TOP):
+    st = pstats.Stats(prof).stats
+    res = []
+    for ((fname, line, func), (cc, nc, tt, ct, _)) in st.items():
+        res.append({
+            'func': f"{os.path.basename(fname)}:{line}({func})",
+            'ncalls': nc,
+            'tottime': round(tt * 1000, 3),
+            'cumtime': round(ct * 1000, 3),
+        })
+    res.sort(key=lambda x: x['tottime'], reverse=True)
+    return res[:n]
+
+
 class handler(BaseHTTPRequestHandler):
     def do_POST(self):
+        self.phases = Phases()
+        self.status = None
+        self.metrics = {'in_bytes': int(self.headers.get('Content-Length') or 0)}
+        self.caches = cacheCounters()
+        self.pota_time = potaloc_stats['time']
+        self.zip_time = zip_stats['time']
+        start = time.perf_counter()
+        prof = cProfile.Profile() if self.profileRequested() else None
+        self.profiling = prof is not None
+        if prof:
+            prof.enable()
+        try:
+            self.route()
+        finally:
+            if prof:
+                prof.disable()
+                self.reportProfile(prof)
+            self.reportMetrics(time.perf_counter() - start)
+
+    def send_response(self, code, message=None):
+        self.status = code
+        super().send_response(code, message)
+
+    def route(self):
         try:
             # パスで処理を分岐
             if self.path.startswith('/api/logconv/hamlog'):
@@ -32,22 +181,133 @@ class handler(BaseHTTPRequestHandler):
                 self.send_error(404, "Not Found")
         except Exception as e:
             logger.error("stack trace:", exc_info=True)
-            self.send_response(500)
-            self.send_header('Content-Type', 'application/json')
+            self.sendJSON({"error": str(e)}, 500)
+
+    def profileRequested(self):
+        if os.environ.get(PROFILE_ENV):
+            return True
+        key = os.environ.get(PROFILE_KEY_ENV)
+        sig = self.headers.get(PROFILE_HEADER)
+        if not key or not sig:
+            return False
+        try:
+            (ts, mac) = sig.split(':', 1)
+            ts = int(ts)
+        except ValueError:
+            return False
+        if abs(time.time() - ts) > PROFILE_WINDOW:
+            return False
+        return hmac.compare_digest(mac, profileSignature(key, ts, self.path))
+
+    def reportProfile(self, prof):
+        report = {
+            'path': self.path,
+            'phases': self.phases.ms(),
+            'top': topFunctions(prof),
+        }
+        outdir = os.environ.get(PROFILE_DIR_ENV)
+        if outdir:
+            fname = os.path.join(
+                outdir, f"logconv-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}.prof")
+            try:
+                prof.dump_stats(fname)
+                report['stats'] = fname
+            except OSError as e:
+                report['stats_error'] = str(e)
+        profile_logger.info(json.dumps(report, ensure_ascii=False))
+
+    def reportMetrics(self, total):
+        now = cacheCounters()
+        caches = {}
+        for (k, (h, m)) in now.items():
+            (h0, m0) = self.caches[k]
+            caches[k] = {'hits': h - h0, 'misses': m - m0}
+        rec = {
+            'path': self.path,
+            'status': self.status,
+            'total': round(total * 1000, 3),
+            'phases': self.phases.ms(),
+            'caches': caches,
+        }
+        rec.update(self.metrics)
+        metrics_logger.info(json.dumps(rec, ensure_ascii=False))
+
+    def splitPhases(self):
+        # 変換中の公園所在地の問い合わせと、変換しながら行ったZIPの圧縮の時間を
+        # convert から pota と zip に付け替える
+        self.phases.split('pota', 'convert', potaloc_stats['time'] - self.pota_time)
+        self.phases.split('zip', 'convert', zip_stats['time'] - self.zip_time)
+        self.pota_time = potaloc_stats['time']
+        self.zip_time = zip_stats['time']
+
+    def serverTiming(self):
+        self.splitPhases()
+        return self.phases.header()
+
+    def respond(self, body, content_type, status=200, headers=()):
+        # body はバイト列またはファイル
+        timing = self.serverTiming()
+        if isinstance(body, bytes):
+            self.metrics['out_bytes'] = len(body)
+        else:
+            self.metrics['out_bytes'] = body.seek(0, io.SEEK_END)
+            body.seek(0)
+        with self.phases('write'):
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            if timing:
+                self.send_header('Server-Timing', timing)
+            for (k, v) in headers:
+                self.send_header(k, v)
             self.end_headers()
-            self.wfile.write(json.dumps({"error": str(e)}).encode('utf-8'))
-    
+            if isinstance(body, bytes):
+                self.wfile.write(body)
+            else:
+                shutil.copyfileobj(body, self.wfile, ZIP_CHUNK)
+            self.wfile.flush()  # flushする！
+
+    def sendJSON(self, res, status=200, **kwargs):
+        self.respond(json.dumps(res, **kwargs).encode('utf-8'),
+                     'application/json', status)
+
+    def sendZIP(self, zip_data, fname):
+        self.respond(zip_data, 'application/zip', headers=[
+            ('Content-Disposition', f"attachment; filename={fname}"),
+            ('Content-Length', str(len(zip_data))),  # 長さ指定！
+        ])
+
+    def zipSink(self):
+        # 変換しながら圧縮して一時ファイルに書き出すZIP
+        return ZipStream(level=zipLevel(self.metrics['in_bytes']))
+
+    def sendZIPStream(self, files, fname):
+        # zip は変換中の圧縮と、ここでのセントラルディレクトリの書き込みの合計
+        self.splitPhases()
+        with self.phases('zip'):
+            zip_file = files.close()
+        self.zip_time = zip_stats['time']
+        try:
+            size = zip_file.seek(0, io.SEEK_END)
+            zip_file.seek(0)
+            self.respond(zip_file, 'application/zip', headers=[
+                ('Content-Disposition', f"attachment; filename={fname}"),
+                ('Content-Length', str(size)),  # 長さ指定！
+            ])
+        finally:
+            zip_file.close()
+
+    def parseForm(self):
+        with self.phases('form'):
+            return cgi.FieldStorage(
+                fp=self.rfile,
+                headers=self.headers,
+                environ={'REQUEST_METHOD': 'POST'}
+            )
+
     def handle_hamlog(self):
-        # content-typeからマルチパートかどうか判断
-        content_type = self.headers.get('Content-Type', '')
-        
         # フォームデータの解析
-        form = cgi.FieldStorage(
-            fp=self.rfile,
-            headers=self.headers,
-            environ={'REQUEST_METHOD': 'POST'}
-        )
-        
+        form = self.parseForm()
+
         # フォームデータの取得
         activation_call = form.getvalue("activation_call")
         chaser_call = form.getvalue("chaser_call")
@@ -71,22 +331,22 @@ class handler(BaseHTTPRequestHandler):
             "POTAActivator": pota_activation_call,
             "POTAOperator": form.getvalue("pota_operator"),
             "Park": form.getvalue("park", ""),
+            "SortQSO": isChecked(form, "sort_qso"),
         }
 
         # ファイルの取得
         if "filename" not in form:
-            self.send_response(400)
-            self.send_header('Content-Type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps({"error": "Please input HAMLOG csv file."}).encode('utf-8'))
+            self.sendJSON({"error": "Please input HAMLOG csv file."}, 400)
             return
-            
+
         fileitem = form["filename"]
         # ファイルデータをStreamに変換
         if fileitem.file:
             fp = fileitem.file
         else:
             fp = io.BytesIO(fileitem.value)
+        counter = CountingReader(fp)
+        fp = io.BufferedReader(counter)
 
         # ファイル名の生成
         now = datetime.datetime.now()
@@ -95,85 +355,65 @@ class handler(BaseHTTPRequestHandler):
         inchar = "cp932"
         outchar = "utf-8"
 
+        # プロファイル時は行ごとのデコード時間も分けて測る。
+        # 入力形式は変換側で判定するので、どのデコーダになっても包めるように渡す
+        decoder = decodeHamlog
+        wrap = None
+        if self.profiling:
+            wrap = lambda f: self.phases.wrap('decode', f)
+
         try:
             if activation_call:
                 callsign = activation_call
                 fname = f"sota-{fname}.zip"
-                files = sendSOTA_A(fp, decodeHamlog, callsign, options, inchar, outchar)
-                zip_data = writeZIP(files)
-                
-                self.send_response(200)
-                self.send_header('Content-Type', 'application/zip')
-                self.send_header('Content-Disposition', f"attachment; filename={fname}")
-                self.end_headers()
-                self.wfile.write(zip_data)
-                self.wfile.flush()  # flushする！
-           
+                with self.phases('convert'):
+                    files = sendSOTA_A(fp, decoder, callsign, options, inchar, outchar,
+                                       files=self.zipSink(), wrap=wrap)
+                self.sendZIPStream(files, fname)
+
             elif chaser_call:
                 callsign = chaser_call
                 fname = f"sota-{fname}.zip"
-                files = sendSOTA_C(fp, decodeHamlog, callsign, options, inchar, outchar)
-                zip_data = writeZIP(files)
-                
-                self.send_response(200)
-                self.send_header('Content-Type', 'application/zip')
-                self.send_header('Content-Disposition', f"attachment; filename={fname}")
-                self.end_headers()
-                self.wfile.write(zip_data)
-                self.wfile.flush()  # flushする！
-            
+                with self.phases('convert'):
+                    files = sendSOTA_C(fp, decoder, callsign, options, inchar, outchar,
+                                       files=self.zipSink(), wrap=wrap)
+                self.sendZIPStream(files, fname)
+
             elif pota_activation_call:
-                files, res = sendADIF(fp, options, inchar, outchar)
                 if command == "ADIFCSVCheck":
-                    self.send_response(200)
-                    self.send_header('Content-Type', 'application/json')
-                    self.end_headers()
-                    self.wfile.write(json.dumps(res).encode('utf-8'))
+                    with self.phases('convert'):
+                        res = checkADIF(fp, options, inchar, outchar, wrap=wrap)
+                    self.sendJSON(res)
                 else:
                     fname = f"adif-{fname}.zip"
-                    zip_data = writeZIP(files)
-                    
-                    self.send_response(200)
-                    self.send_header('Content-Type', 'application/zip')
-                    self.send_header('Content-Disposition', f"attachment; filename={fname}")
-                    self.send_header('Content-Length', str(len(zip_data)))  # 長さ指定！
-                    self.end_headers()
-                    
-                    self.wfile.write(zip_data)
-                    self.wfile.flush()  # flushする！
+                    with self.phases('convert'):
+                        files, res = sendADIF(fp, options, inchar, outchar,
+                                              files=self.zipSink(), wrap=wrap)
+                    self.sendZIPStream(files, fname)
             else:
                 fname = f"airhamlog-{fname}"
-                files = sendAirHamLog(fp, fname+".csv", decodeHamlog, options, inchar, outchar)
-                zip_data = writeZIP(files)
-                self.send_response(200)
-                self.send_header('Content-Type', 'application/zip')
-                self.send_header('Content-Disposition', f"attachment; filename={fname}.zip")
-                self.end_headers()
-                self.wfile.write(zip_data)
-                self.wfile.flush()  # flushする！
-                
+                with self.phases('convert'):
+                    files = sendAirHamLog(fp, fname+".csv", decoder, options, inchar, outchar,
+                                          files=self.zipSink(), wrap=wrap)
+                self.sendZIPStream(files, f"{fname}.zip")
+
         except Exception as e:
             logger.error("stack trace:", exc_info=True)
             logger.error(f"options: {options}")
-            self.send_response(500)
-            self.send_header('Content-Type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps({"error": str(e)}).encode('utf-8'))
-    
+            self.sendJSON({"error": str(e)}, 500)
+        finally:
+            self.metrics['file_bytes'] = counter.nbytes
+            self.metrics['rows'] = counter.nlines
+
     def handle_fleonline(self):
-        # content-typeからマルチパートかどうか判断
-        content_type = self.headers.get('Content-Type', '')
-        
         # フォームデータの解析
-        form = cgi.FieldStorage(
-            fp=self.rfile,
-            headers=self.headers,
-            environ={'REQUEST_METHOD': 'POST'}
-        )
-        
+        form = self.parseForm()
+
         command = form.getvalue("command", None)
         arg = form.getvalue("arg", json.dumps("None"))
         text = form.getvalue("edittext", None)
+        store_input = isChecked(form, "store_input")
+        sort_qso = isChecked(form, "sort_qso")
 
         now = datetime.datetime.now()
         fname = "fle-" + now.strftime("%Y-%m-%d-%H-%M") + ".zip"
@@ -181,50 +421,38 @@ class handler(BaseHTTPRequestHandler):
         try:
             if command:
                 if len(arg) < 131072:
-                    res = do_command(command, arg)
-                    
-                    self.send_response(200)
-                    self.send_header('Content-Type', 'application/json')
-                    self.end_headers()
-                    self.wfile.write(json.dumps(res).encode('utf-8'))
+                    with self.phases('convert'):
+                        res = do_command(command, arg)
+                    self.sendJSON(res)
                 else:
-                    self.send_response(500)
-                    self.send_header('Content-Type', 'application/json')
-                    self.end_headers()
-                    self.wfile.write(json.dumps({"error": "Line too long"}).encode('utf-8'))
+                    self.sendJSON({"error": "Line too long"}, 500)
             elif text:
-                zip_data = compileFLE(text, True)
-                
-                self.send_response(200)
-                self.send_header('Content-Type', 'application/zip')
-                self.send_header('Content-Disposition', f"attachment; filename={fname}")
-                self.send_header('Content-Length', str(len(zip_data)))  # 長さ指定！
-      
-                self.end_headers()
-                self.wfile.write(zip_data)
-                self.wfile.flush()  # flushする！
-        
+                self.metrics['rows'] = text.count('\n') + 1
+                with self.phases('convert'):
+                    zip_data = compileFLE(text, True, store_input, sort_qso)
+                self.sendZIP(zip_data, fname)
+
         except Exception as e:
             logger.error("stack trace:", exc_info=True)
             logger.error(f"options: {command, arg, text}")
-            self.send_response(500)
-            self.send_header('Content-Type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps({"error": str(e)}).encode('utf-8'))
-    
+            self.sendJSON({"error": str(e)}, 500)
+
     def handle_wspr(self):
         # フォームデータの解析
-        form = cgi.FieldStorage(
-            fp=self.rfile,
-            headers=self.headers,
-            environ={'REQUEST_METHOD': 'POST'}
-        )
-        
+        form = self.parseForm()
+
         arg = form.getvalue("arg", None)
-        svg_buffer = WSPRspots(arg)
-        
-        self.send_response(200)
-        self.send_header('Content-Type', 'image/svg+xml')
-        self.end_headers()
-        self.wfile.write(svg_buffer.getvalue())
-        
\ No newline at end of file
+        fmt = form.getvalue("format", "svg")
+        if arg:
+            # spots はJSON文字列の中で改行区切り
+            self.metrics['rows'] = arg.count('\\n') + 1
+
+        if fmt == "json":
+            with self.phases('convert'):
+                res = WSPRstats(arg)
+            self.sendJSON(res, separators=(',', ':'))
+            return
+
+        with self.phases('render'):
+            svg_buffer = WSPRspots(arg)
+        self.respond(svg_buffer.getvalue(), 'image/svg+xml')
@@ -14,9 +14,7 @@ import sys
 from io import BytesIO
 
 
-def WSPRspots(jstr):
-
-    js = json.loads(jstr)
+def aggregateWSPR(js):
 
     plots = []
     for p in js["plots"]:
@@ -45,7 +43,6 @@ def WSPRspots(jstr):
 
     mindist = int(js["min"])
     maxdist = int(js["max"])
-    addlabel = js["label"]
 
     wsprspot = []
     reporter = {}
@@ -125,10 +122,6 @@ def WSPRspots(jstr):
             else:
                 break
 
-    fig, axes = plt.subplots(1, 1)
-
-    fig.set_figwidth(int(js["width"]) / 120)
-
     for rp in cmnlst:
         for j in range(0, i):
             l = cmnrptr[rp]["snr"][j]
@@ -138,6 +131,45 @@ def WSPRspots(jstr):
                 plots[j]["avgsnr"].append(0)
             plots[j]["avgdist"].append(cmnrptr[rp]["dist"])
 
+    return plots, cmnlst
+
+
+def WSPRstats(jstr):
+
+    js = json.loads(jstr)
+    plots, cmnlst = aggregateWSPR(js)
+
+    return {
+        "title": js["title"],
+        "reporters": cmnlst,
+        "plots": [
+            {
+                "label": p["label"],
+                "color": p["color"],
+                "from": p["from"],
+                "to": p["to"],
+                "spots": len(p["snr"]),
+                "repo": p["repo"],
+                "dist": p["dist"],
+                "snr": p["snr"],
+                "avgdist": p["avgdist"],
+                "avgsnr": [round(v, 2) for v in p["avgsnr"]],
+            }
+            for p in plots
+        ],
+    }
+
+
+def WSPRspots(jstr):
+
+    js = json.loads(jstr)
+    plots, _ = aggregateWSPR(js)
+    addlabel = js["label"]
+
+    fig, axes = plt.subplots(1, 1)
+
+    fig.set_figwidth(int(js["width"]) / 120)
+
     for p in plots:
         x = p["dist"]
         y = p["snr"]
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+# ADIF出力: csv.writer(delimiter=' ') と ADIFWriter の比較
+#   python -m benchmarks.adif_writer [レコード数]
+import csv
+import io
+import random
+import sys
+import time
+
+from api.convutil import ADIFWriter, adif
+from benchmarks.gen import calls, bands, modes
+
+
+def records(n, seed=1):
+    r = random.Random(seed)
+    for i in range(n):
+        (mode, rst_s, rst_r) = r.choice(modes)
+        yield [('activator', 'JL1NIE/1'), ('callsign', r.choice(calls)),
+               ('date', '20240501'), ('time', f'{i // 60 % 24:02}{i % 60:02}'),
+               ('band-wlen', r.choice(bands)[1]), ('mode', mode),
+               ('rst_sent', rst_s), ('rst_rcvd', rst_r),
+               ('mysig', 'POTA'), ('mysiginfo', 'JA-0005'),
+               ('sig', 'POTA'), ('siginfo', 'JA-1234'),
+               ('operator', 'JL1NIE'), '<EOR>']
+
+
+def viaCSV(recs):
+    out = io.StringIO()
+    writer = csv.writer(out, delimiter=' ', quoting=csv.QUOTE_MINIMAL)
+    for l in recs:
+        writer.writerow([f if isinstance(f, str) else adif(*f) for f in l])
+    return out.getvalue()
+
+
+def viaWriter(recs):
+    out = io.StringIO()
+    writer = ADIFWriter(out)
+    for l in recs:
+        writer.writerow(l)
+    return out.getvalue()
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    recs = list(records(n))
+    # ASCII で空白を含まなければ同じ出力になる
+    assert viaCSV(recs) == viaWriter(recs)
+    for label, f in [('csv.writer', viaCSV), ('ADIFWriter', viaWriter)]:
+        best = None
+        for _ in range(5):
+            t = time.perf_counter()
+            f(recs)
+            e = time.perf_counter() - t
+            best = e if best is None else min(best, e)
+        print(f'{label:10} {best*1000:8.1f}ms {n / best:12,.0f} rec/s')
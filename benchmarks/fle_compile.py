@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+# coding: utf-8
+# buildFLE のプロファイル付き計測
+#   python -m benchmarks.fle_compile [行数] [上位件数]
+import cProfile
+import io
+import pstats
+import sys
+import time
+
+import api.fleonline as fle
+from benchmarks.gen import fleLog
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    top = int(sys.argv[2]) if len(sys.argv) > 2 else 12
+    text = fleLog(n)
+    for conv_mode in (False, True):
+        fle.tokenizer.cache_clear()
+        fle.buildFLE(text, conv_mode)
+        best = None
+        for _ in range(3):
+            t = time.perf_counter()
+            fle.buildFLE(text, conv_mode)
+            e = time.perf_counter() - t
+            best = e if best is None else min(best, e)
+        print(f'conv_mode={conv_mode}: {best*1000:.1f}ms '
+              f'({n/best:,.0f} lines/s)')
+
+        prof = cProfile.Profile()
+        prof.enable()
+        fle.buildFLE(text, conv_mode)
+        prof.disable()
+        out = io.StringIO()
+        pstats.Stats(prof, stream=out).sort_stats('tottime').print_stats(top)
+        print(out.getvalue())
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+# coding: utf-8
+# FLEトークナイザ: 旧実装(1文字ずつ連結)との等価性チェックと処理速度
+#   python -m benchmarks.fle_scanner [ランダム行数] [ログ行数]
+import random
+import re
+import sys
+import time
+
+import api.fleonline as fle
+from api.fleonline import (
+    freq_to_band,
+    band_to_freq,
+    keyword,
+    modes,
+    parseCallsign
+)
+from benchmarks.gen import fleLog
+
+
+# 以下は書き換え前の実装(参照用)
+def get_token(pos, line):
+    res = ''
+    while pos < len(line):
+        c = line[pos]
+        if c == ' ' or c == '　':
+            if res != '':
+                return (pos+1, res)
+            else:
+                pos += 1
+        elif c in '#<[{':
+            return (pos+1, c)
+        else:
+            res = res + c
+            pos += 1
+    return (pos, res)
+
+
+def get_comment(pos, line):
+    res = ""
+    while pos < len(line):
+        c = line[pos]
+        if c in '>]}':
+            return (pos+1, res)
+        else:
+            res = res + c
+            pos += 1
+    return (pos, res)
+
+
+def refTokenizer(line):
+    res = []
+    pos = 0
+
+    while pos < len(line):
+        pos, word = get_token(pos, line)
+        w = word.upper()
+        if w == '#':
+            break
+        if w == '':
+            continue
+        if w in '<[{':
+            pos, comment = get_comment(pos, line)
+            res.append(('comment', w, comment))
+            continue
+        m = re.match(r'(\d+)-(\d+)-(\d+)$', w)
+        if m:
+            res.append(('date', (m.group(1), m.group(2), m.group(3)), w))
+            continue
+        m = re.match(r'(\d+)-(\d+)$', w)
+        if m:
+            res.append(('date2', (m.group(1), m.group(2)), w))
+            continue
+        m = re.match(r'(\d+)/(\d+)/(\d+)$', w)
+        if m:
+            res.append(('date', (m.group(1), m.group(2), m.group(3)), w))
+            continue
+        m = re.match(r'(\d+)/(\d+)$', w)
+        if m:
+            res.append(('date2', (m.group(1), m.group(2)), w))
+            continue
+        m = re.match(r'\d+\.\d+$', w)
+        if m:
+            res.append(('freq', freq_to_band(w), w))
+            continue
+        m = re.match(r'[-\+]\d+$', w)
+        if m:
+            res.append(('snr', w, w))
+            continue
+        bd = band_to_freq(w, is_sota=True)
+        if bd:
+            res.append(('band', bd, word))
+            continue
+        m = re.match(r'\w+FF-\d+$', w)
+        if m:
+            res.append(('wwffref', w, word))
+            continue
+        m = re.match(r'\w+/\w+-\d+$', w)
+        if m:
+            res.append(('sotaref', w, word))
+            continue
+        m = re.match(r'\w+-\d+$', w)
+        if m:
+            res.append(('potaref', w, word))
+            continue
+        kw = keyword(w)
+        if kw:
+            if w == 'QSLMSG':
+                w2 = re.sub(r'qslmsg\s+', '', line)
+                res.append(('kw', kw, w2))
+                break
+            elif w == 'QSLMSG2':
+                w2 = re.sub(r'qslmsg2\s+', '', line)
+                res.append(('kw', kw, w2))
+                break
+            else:
+                res.append(('kw', kw, word))
+                continue
+        md = modes(w)
+        if md:
+            res.append(('md', md, word))
+            continue
+        m = re.match(r'\d+$', w)
+        if m:
+            res.append(('dec', len(w), w))
+            continue
+        m = parseCallsign(w)
+        if m:
+            res.append(('call', w.upper(), word))
+            continue
+        m = re.match(r'\.\w+', w)
+        if m:
+            res.append(('ctstsent', w.upper(), word))
+            continue
+        m = re.match(r',\w+', w)
+        if m:
+            res.append(('ctstrcvd', w.upper(), word))
+            continue
+        m = re.match(r'.*[/\-]+.*', w)
+        if m:
+            res.append(('unknown', w, word))
+            continue
+        else:
+            res.append(('literal', w.upper(), word))
+            continue
+    return tuple(res)
+
+
+
+alphabet = ('abcJAFF0123456789/-.,+ 　\t#<[{>]}' +
+            'ｱ漢ß')
+pieces = ['JA1ABC', 'ja/kn-006', 'JAFF-0012', 'JA-1234', '7.025', '40m',
+          'cw', 'ft8', '599', '-10', '2024/05/01', '5-1', 'qslmsg',
+          'qslmsg2', 'day', '+', '.12', ',005', 'mycall', 'date']
+
+
+def randomLine(r):
+    l = []
+    for _ in range(r.randint(0, 12)):
+        if r.random() < 0.5:
+            l.append(r.choice(pieces))
+        else:
+            l.append(''.join(r.choice(alphabet)
+                             for _ in range(r.randint(0, 6))))
+    return ''.join(w + r.choice([' ', ' ', '　', '', '  ']) for w in l)
+
+
+def outcome(tok, l):
+    # freq_to_band は範囲外の周波数で例外を出すので、例外も比較対象にする
+    try:
+        return tok(l)
+    except Exception as e:
+        return (type(e), str(e))
+
+
+def check(n, seed=1):
+    r = random.Random(seed)
+    new = fle.tokenizer.__wrapped__
+    bad = 0
+    for _ in range(n):
+        l = randomLine(r)
+        a = outcome(refTokenizer, l)
+        b = outcome(new, l)
+        if a != b:
+            bad += 1
+            if bad <= 5:
+                print('mismatch:', repr(l))
+                print('  old:', a)
+                print('  new:', b)
+    return bad
+
+
+def throughput(lines, tok):
+    best = None
+    for _ in range(3):
+        t = time.perf_counter()
+        for l in lines:
+            tok(l)
+        e = time.perf_counter() - t
+        best = e if best is None else min(best, e)
+    return best
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    m = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+    bad = check(n)
+    print(f'equivalence: {n} random lines, {bad} mismatches')
+
+    lines = fleLog(m).splitlines()
+    for name, tok in (('old', refTokenizer),
+                      ('new', fle.tokenizer.__wrapped__)):
+        e = throughput(lines, tok)
+        print(f'{name}: {e*1000:.1f}ms ({m/e:,.0f} lines/s)')
+    sys.exit(1 if bad else 0)
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+# coding: utf-8
+# キャッシュに入らない大きな FLE 入力の変換: レコードのリスト (parseFLE) と
+# 2回走査 (streamFLE) の出力・時間・ピークメモリの比較
+#   python -m benchmarks.fle_stream [行数]
+# 出力が一致しなければ終了コード 1。
+import io
+import re
+import sys
+import time
+import tracemalloc
+import zipfile
+
+import api.convutil as cu
+import api.fleonline as fle
+from benchmarks.gen import fleLog
+
+
+def stubPOTALoc(parkid):
+    return ['JP-13']
+
+
+def unzip(data):
+    z = zipfile.ZipFile(io.BytesIO(data))
+    # ファイル名の変換時刻は比較しない
+    return {re.sub(r'\d{4}-\d\d-\d\d-\d\d-\d\d', 'TS', n): z.read(n)
+            for n in z.namelist()}
+
+
+def measure(f):
+    t = time.perf_counter()
+    f()
+    e = time.perf_counter() - t
+    tracemalloc.start()
+    f()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return (e, peak)
+
+
+if __name__ == '__main__':
+    cu.getPOTALoc = cu.fetchPOTALoc = stubPOTALoc
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    text = fleLog(n)
+    print(f'{n} lines, {len(text):,} chars '
+          f'(cache limit {fle.FLE_CACHE_INPUT_MAX:,})')
+    same = True
+    for sort_qso in (False, True):
+        a = fle.buildFLE(text, True, False, sort_qso, fle.parseFLE(text))
+        b = fle.buildFLE(text, True, False, sort_qso, fle.streamFLE(text))
+        ok = unzip(a) == unzip(b)
+        same = same and ok
+        print(f'sort_qso={sort_qso}: {"same" if ok else "DIFFERENT"}')
+    for label, parse in [('list', fle.parseFLE), ('stream', fle.streamFLE)]:
+        (e, peak) = measure(
+            lambda: fle.buildFLE(text, True, parsed=parse(text)))
+        print(f'{label:7} {e*1000:8.1f}ms peak {peak / 1e6:6.1f}MB')
+    sys.exit(0 if same else 1)
@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+# coding: utf-8
+# FLEトークナイザのメモ化効果の計測
+#   python -m benchmarks.fle_tokenizer [行数]
+import sys
+import time
+
+import api.fleonline as fle
+from benchmarks.gen import fleLog
+
+
+def run(text, tok):
+    spent = [0.0]
+
+    def timed(line):
+        t = time.perf_counter()
+        r = tok(line)
+        spent[0] += time.perf_counter() - t
+        return r
+
+    fle.tokenizer = timed
+    try:
+        t = time.perf_counter()
+        fle.buildFLE(text, False)
+        total = time.perf_counter() - t
+    finally:
+        fle.tokenizer = cached
+    return total, spent[0]
+
+
+cached = fle.tokenizer
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    text = fleLog(n)
+    cached.cache_clear()
+    for label, tok in [('uncached', cached.__wrapped__),
+                       ('memo cold', cached),
+                       ('memo warm', cached)]:
+        total, spent = run(text, tok)
+        print(f'{label:10} total {total*1000:8.1f}ms  '
+              f'tokenizer {spent*1000:8.1f}ms ({spent/total*100:4.1f}%)')
+    print(cached.cache_info())
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# coding: utf-8
+# ベンチマーク用の合成ログ生成
+import datetime
+import json
+import random
+
+calls = ['JA1ABC', 'JH1XYZ', 'JR2QQQ', 'JA3BBB', 'JF1AAA', 'JE1CCC', 'JL1DDD',
+         'JA7EEE', '7K1FFF', 'JN1GGG', 'JA1HHH/1', 'JO1III', 'JI1JJJ']
+refs = ['', '', '', '', 'ja/tk-001', 'JA-1234', 'jaff-0012', '{PM95ab}',
+        '<Taro>', '{AO-91/FM/145960}']
+his_refs = ['', '', '', 'JA/TK-001', 'JA-1234', 'JAFF-0012', 'PM95ab',
+            'JA/KN-006 JA-1234', 'AO-91/FM/145960', 'QM05aa']
+my_refs = ['JA/KN-006 JA-0005', 'JA/KN-006', 'JA-0005 JP-1234',
+           'JA/KN-007 JA-0005']
+bands = [('3.535', '80m'), ('7.025', '40m'), ('10.120', '30m'),
+         ('14.062', '20m'), ('21.050', '15m'), ('28.150', '10m'),
+         ('50.250', '6m'), ('144.050', '2m'), ('433.100', '70cm')]
+modes = [('CW', '599', '579'), ('SSB', '59', '57'), ('FM', '59', '55'),
+         ('FT8', '-10', '-15')]
+
+
+def clock(r, n):
+    # 日付順に進む (年, 月, 日, 時, 分)
+    day = 0
+    minute = 9 * 60
+    for _ in range(n):
+        minute += r.randint(0, 4)
+        if minute >= 24 * 60 or r.random() < 0.002:
+            minute = r.randint(0, 12 * 60)
+            day += 1
+        d = 1 + day % 28
+        m = 1 + (day // 28) % 12
+        yield (2024, m, d, minute // 60, minute % 60)
+
+
+def scattered(r, n, days):
+    # 2020-01-01 から days 日の間にばらばらの順で散らばる時刻
+    start = datetime.datetime(2020, 1, 1)
+    for _ in range(n):
+        t = start + datetime.timedelta(days=r.randrange(days),
+                                       minutes=r.randrange(24 * 60))
+        yield (t.year, t.month, t.day, t.hour, t.minute)
+
+
+def hamlogCSV(n, seed=1, days=None):
+    # days を指定すると、その日数に散らばった日付順でないログになる
+    r = random.Random(seed)
+    lines = []
+    for (y, mo, d, h, mi) in (scattered(r, n, days) if days else clock(r, n)):
+        (freq, _) = r.choice(bands)
+        (mode, rsts, rstr) = r.choice(modes)
+        lines.append(','.join([
+            r.choice(calls), f'{y % 100:02}/{mo:02}/{d:02}',
+            f'{h:02}:{mi:02}' + r.choice('JJJU'), rsts, rstr, freq, mode,
+            '', 'PM95', r.choice(['J  ', 'N  ', 'JJ ']),
+            r.choice(['Taro', 'Jiro', '花子', '']), r.choice(['Tokyo', '東京都', '']),
+            r.choice(my_refs), r.choice(his_refs), '0']))
+    return '\r\n'.join(lines) + '\r\n'
+
+
+def hamlogIOS(n, seed=1):
+    r = random.Random(seed)
+    lines = ['Date,TimeOn,Freq,Call,RSTr,RSTs,GL,Name,QTH,X9,X10,Mode,X12,'
+             'Rmks2,QSL,QSLs,QSLr,X17,X18']
+    for (y, mo, d, h, mi) in clock(r, n):
+        (freq, _) = r.choice(bands)
+        (mode, rsts, rstr) = r.choice(modes)
+        lines.append(','.join([
+            f'{y}-{mo:02}-{d:02} {h:02}:{mi:02}:00 +0900', '', freq,
+            r.choice(calls), rstr, rsts, 'PM95', r.choice(['Taro', '花子']),
+            r.choice(my_refs), '', '', mode, '', r.choice(his_refs),
+            'J', '1', '0', '', '']))
+    return '\r\n'.join(lines) + '\r\n'
+
+
+def adifText(n, seed=1):
+    r = random.Random(seed)
+
+    def f(k, v):
+        return f'<{k}:{len(v)}>{v}'
+
+    lines = ['ADIF Export from HAMLOG', f('ADIF_VER', '3.1.4') + ' <EOH>']
+    for (y, mo, d, h, mi) in clock(r, n):
+        (freq, band) = r.choice(bands)
+        (mode, rsts, rstr) = r.choice(modes)
+        rec = [f('CALL', r.choice(calls)), f('QSO_DATE', f'{y}{mo:02}{d:02}'),
+               f('TIME_ON', f'{h:02}{mi:02}'),
+               r.choice([f('FREQ', freq), f('BAND', band)]), f('MODE', mode),
+               f('RST_SENT', rsts), f('RST_RCVD', rstr),
+               f('MY_SIG_INFO', r.choice(['JA-0005', 'JA-0005,JP-1234']))]
+        ref = r.choice(['', 'JA-1234', 'JP-0001'])
+        if ref:
+            rec.append(f('SIG_INFO', ref))
+        lines.append(' '.join(rec) + ' <EOR>')
+    return '\r\n'.join(lines) + '\r\n'
+
+
+def fleLog(n, seed=1):
+    r = random.Random(seed)
+    lines = ['mycall JL1NIE/1', 'mysota JA/KN-006', 'mypota JA-0005',
+             'qslmsg TNX QSO from $mysota $sat $rig', 'timezone +9',
+             'date 2024/05/01', '40m cw']
+    minute = 0
+    while len(lines) < n:
+        x = r.random()
+        if x < 0.02:
+            lines.append('day +')
+        elif x < 0.06:
+            lines.append(r.choice(['40m cw', '20m ssb', '7.025', '15m ft8',
+                                   'cw', '40m', '2m fm', '14.062 cw']))
+        else:
+            minute = (minute + r.randint(0, 3)) % 60
+            t = r.choice(['', '', str(minute % 10), f'{minute:02}',
+                          f'{r.randint(0, 23):02}{minute:02}'])
+            rst = r.choice(['', '', '', '579 559', '59 57', '5 7'])
+            words = [t, r.choice(calls), rst, r.choice(refs)]
+            lines.append(' '.join(w for w in words if w))
+    return '\n'.join(lines[:n])
+
+
+def wsprJSON(n, seed=1):
+    r = random.Random(seed)
+    spots = []
+    for i in range(n):
+        ts = 2 * i
+        spots.append(' '.join([
+            f'2024-05-{1 + ts // 1440:02}', f'{ts // 60 % 24:02}:{ts % 60:02}',
+            'JL1NIE', '7.040', str(-r.randint(0, 28)), '0', 'PM95', '5',
+            f'R{r.randint(0, 300)}', 'GRID', str(r.randint(100, 18000)),
+            str(r.randint(0, 359)), 'x']))
+    last = 2 * n
+    plots = []
+    for (i, c) in enumerate(['red', 'blue', 'green']):
+        fm = last * i // 3
+        to = last * (i + 1) // 3 - 1
+        plots.append({
+            'label': 'ABC'[i], 'color': c,
+            'from': f'2024-05-{1 + fm // 1440:02} {fm // 60 % 24:02}:{fm % 60:02}',
+            'to': f'2024-05-{1 + to // 1440:02} {to // 60 % 24:02}:{to % 60:02}'})
+    return json.dumps({'plots': plots, 'min': '0', 'max': '20000',
+                       'label': True, 'width': '800', 'title': 'bench',
+                       'spots': '\n'.join(spots)})
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# coding: utf-8
+# HAMLOG CSV (cp932) のデコード速度
+#   python -m benchmarks.hamlog_decode [行数]
+# csv の読み込みだけ、decodeHamlog だけ、読み込み+デコードを分けて行/秒を出す。
+# 先に範囲外の日付(UTC にすると年 1 より前・9999 より後)が例外にならず
+# 行ごとの日付エラーになることを確かめる。
+import csv
+import io
+import sys
+import time
+
+from api.convutil import decodeHamlog
+from benchmarks.gen import hamlogCSV
+
+
+def readRows(data):
+    with io.TextIOWrapper(io.BytesIO(data), encoding='cp932',
+                          errors='backslashreplace') as f:
+        return list(csv.reader(f))
+
+
+def decodeRows(rows):
+    for row in rows:
+        decodeHamlog(row)
+
+
+def readDecode(data):
+    with io.TextIOWrapper(io.BytesIO(data), encoding='cp932',
+                          errors='backslashreplace') as f:
+        for row in csv.reader(f):
+            decodeHamlog(row)
+
+
+# (日付, 時刻, エラーになるか)
+edges = [('0001/01/01', '00:10J', True),
+         ('0001/01/01', '00:10U', False),
+         ('9999/12/31', '23:50J', False),
+         ('9999/12/31', '23:50U', False),
+         ('2024/02/30', '12:00J', True)]
+
+
+def checkEdges():
+    for (date, time_, error) in edges:
+        row = ['JA1ABC', date, time_, '599', '599', '7.025', 'CW',
+               '', '', '', '', '', '', '', '0']
+        res = decodeHamlog(row)
+        assert res['error'] == error, (date, time_, res['errormsg'])
+
+
+def best(f, arg, repeat=5):
+    b = None
+    for _ in range(repeat):
+        t = time.perf_counter()
+        f(arg)
+        e = time.perf_counter() - t
+        b = e if b is None else min(b, e)
+    return b
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    checkEdges()
+    data = hamlogCSV(n).encode('cp932')
+    rows = readRows(data)
+    print(f'{n} rows, {len(data):,} bytes cp932')
+    for label, f, arg in [('csv read', readRows, data),
+                          ('decode', decodeRows, rows),
+                          ('read+decode', readDecode, data)]:
+        e = best(f, arg)
+        print(f'{label:12} {e*1000:8.1f}ms {n / e:12,.0f} rows/s')
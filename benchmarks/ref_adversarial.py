@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# coding: utf-8
+# get_ref と FLE トークナイザの最悪ケースの所要時間
+#   python -m benchmarks.ref_adversarial [最大文字数] [上限ms]
+# 正規表現のバックトラックが起きやすい入力を与え、1回あたりの時間を測る。
+# 文字数上限なし(REF_FIELD_MAX を外す)でも入力長にほぼ比例すること、
+# 通常の get_ref が上限ms を超えないことを確かめる。超えたら終了コード 1。
+import sys
+import time
+
+import api.convutil as cu
+import api.fleonline as fle
+
+inputs = {
+    'digits': lambda n: '1' * n,
+    'digits-dot': lambda n: '1.' * (n // 2),
+    'digits-ws': lambda n: '1' + ' ' * n,
+    'digits-comma': lambda n: '1 ,' * (n // 3),
+    'alnum': lambda n: 'A' * n,
+    'ff': lambda n: 'AF' * (n // 2) + 'F-',
+    'slash': lambda n: 'A' * (n // 2) + '/' + 'A' * (n // 2),
+    'sat': lambda n: 'A' * (n // 2) + '-' + '1' * (n // 2) + '/',
+    'dash': lambda n: '1-' * (n // 2),
+    'mixed': lambda n: ('JA/KN-006 35.5N,139.5E AAAA1111 ' * (n // 32 + 1))[:n],
+}
+
+
+def timed(f, s, repeat=3):
+    best = None
+    for _ in range(repeat):
+        t = time.perf_counter()
+        f(s)
+        e = time.perf_counter() - t
+        best = e if best is None else min(best, e)
+    return best
+
+
+def uncapped(s):
+    cap = cu.REF_FIELD_MAX
+    cu.REF_FIELD_MAX = len(s)
+    try:
+        return cu.get_ref(s)
+    finally:
+        cu.REF_FIELD_MAX = cap
+
+
+if __name__ == '__main__':
+    nmax = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    budget = float(sys.argv[2]) if len(sys.argv) > 2 else 20.0
+    sizes = [n for n in (1000, 10000, 100000, 1000000) if n <= nmax]
+    worst = 0.0
+    print(f'{"input":12} {"chars":>8} {"get_ref":>10} {"uncapped":>10} {"tokenizer":>10}')
+    for name, f in inputs.items():
+        for n in sizes:
+            s = f(n)
+            e = timed(cu.get_ref, s)
+            worst = max(worst, e)
+            u = timed(uncapped, s)
+            t = timed(fle.tokenizer.__wrapped__, s)
+            print(f'{name:12} {n:>8} {e*1000:8.2f}ms {u*1000:8.2f}ms {t*1000:8.2f}ms')
+    print(f'worst get_ref {worst*1000:.2f}ms (budget {budget}ms)')
+    sys.exit(0 if worst * 1000 <= budget else 1)
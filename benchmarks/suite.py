@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+# coding: utf-8
+# 変換処理全体のベンチマーク
+#   python -m benchmarks.suite [-s 1000,10000,100000] [-c ケース,...] [-o 出力JSON]
+# ケースごとに子プロセスで実行し、行/秒とピークRSSを JSON に書き出す。
+# getPOTALoc はスタブに差し替えるのでオフラインで動く。
+import argparse
+import datetime
+import io
+import json
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+from benchmarks import gen
+
+potaloc = {'JA-0005': ['JP-13'], 'JP-1234': ['JP-13', 'JP-14'],
+           'JA-1234': ['JP-12'], 'JP-0001': ['JP-01']}
+
+
+def stubPOTALoc(parkid):
+    return potaloc.get(parkid, ['UNKNOWN'])
+
+
+def options(**kw):
+    o = {
+        "Portable": "", "QTH": "rmks2", "hisQTH": "", "hisQTHopt": "",
+        "myQTH": "rmks1", "Note": "", "Summit": "", "Location": "",
+        "WWFFOperator": "", "WWFFActivator": "", "WWFFRef": "",
+        "SOTAActivator": None, "POTAActivator": None, "POTAOperator": None,
+        "Park": "",
+    }
+    o.update(kw)
+    return o
+
+
+def caseAirHam(cu, n):
+    data = gen.hamlogCSV(n).encode('cp932')
+    return lambda files=None: cu.sendAirHamLog(io.BytesIO(data), 'airham.csv',
+                                               cu.decodeHamlog, options(),
+                                               'cp932', 'utf-8', files=files)
+
+
+def caseSOTA_A(cu, n):
+    data = gen.hamlogCSV(n).encode('cp932')
+    return lambda files=None: cu.sendSOTA_A(io.BytesIO(data), cu.decodeHamlog,
+                                            'JL1NIE/1', options(SOTAActivator='JL1NIE/1'),
+                                            'cp932', 'utf-8', files=files)
+
+
+def caseSOTA_A_sorted(cu, n):
+    data = gen.hamlogCSV(n).encode('cp932')
+    return lambda files=None: cu.sendSOTA_A(io.BytesIO(data), cu.decodeHamlog,
+                                            'JL1NIE/1', options(SOTAActivator='JL1NIE/1',
+                                                                SortQSO=True),
+                                            'cp932', 'utf-8', files=files)
+
+
+def caseSOTA_A_scattered(cu, n):
+    # 日付順でない入力。日付(出力ファイル)の数が多いときのメモリを見る
+    data = gen.hamlogCSV(n, days=max(1, n // 10)).encode('cp932')
+    return lambda files=None: cu.sendSOTA_A(io.BytesIO(data), cu.decodeHamlog,
+                                            'JL1NIE/1', options(SOTAActivator='JL1NIE/1'),
+                                            'cp932', 'utf-8', files=files)
+
+
+def caseSOTA_C(cu, n):
+    data = gen.hamlogCSV(n).encode('cp932')
+    return lambda files=None: cu.sendSOTA_C(io.BytesIO(data), cu.decodeHamlog,
+                                            'JL1NIE', options(), 'cp932', 'utf-8', files=files)
+
+
+def caseADIF(cu, n):
+    data = gen.hamlogCSV(n).encode('cp932')
+    return lambda files=None: cu.sendADIF(io.BytesIO(data),
+                                          options(POTAActivator='JL1NIE/1'),
+                                          'cp932', 'utf-8', files=files)[0]
+
+
+def caseADIF_IOS(cu, n):
+    data = gen.hamlogIOS(n).encode('cp932')
+    return lambda files=None: cu.sendADIF(io.BytesIO(data),
+                                          options(POTAActivator='JL1NIE'),
+                                          'cp932', 'utf-8', files=files)[0]
+
+
+def caseADIF_ADIF(cu, n):
+    data = gen.adifText(n).encode('cp932')
+    return lambda files=None: cu.sendADIF(io.BytesIO(data),
+                                          options(POTAActivator='JL1NIE', myQTH='park',
+                                                  Park='JA-0005 JP-1234'),
+                                          'cp932', 'utf-8', files=files)[0]
+
+
+def caseADIFCheck(cu, n):
+    data = gen.adifText(n).encode('cp932')
+    return lambda: cu.checkADIF(io.BytesIO(data),
+                                options(POTAActivator='JL1NIE', myQTH='park',
+                                        Park='JA-0005 JP-1234'),
+                                'cp932', 'utf-8')
+
+
+def streamed(case):
+    # 出力を ZipStream に書く(行数上限なし)
+    def stream(cu, n):
+        run = case(cu, n)
+        return lambda: run(cu.ZipStream()).getvalue()
+    return stream
+
+
+def caseFLE(conv_mode):
+    def case(cu, n):
+        import api.fleonline as fle
+        text = gen.fleLog(n)
+
+        def run():
+            # キャッシュの効かない初回変換を測る
+            fle.fle_cache.clear()
+            fle.tokenizer.cache_clear()
+            return fle.compileFLE(text, conv_mode)
+        return run
+    return case
+
+
+def caseWSPR(cu, n):
+    from api.wspr import WSPRspots
+    js = gen.wsprJSON(n)
+    return lambda: WSPRspots(js)
+
+
+cases = {
+    'airham': caseAirHam,
+    'sota_a': caseSOTA_A,
+    'sota_c': caseSOTA_C,
+    'adif_hamlog': caseADIF,
+    'adif_ios': caseADIF_IOS,
+    'adif_adif': caseADIF_ADIF,
+    'adif_check': caseADIFCheck,
+    'airham_zs': streamed(caseAirHam),
+    'sota_a_zs': streamed(caseSOTA_A),
+    'sota_a_sorted_zs': streamed(caseSOTA_A_sorted),
+    'sota_a_scattered_zs': streamed(caseSOTA_A_scattered),
+    'adif_adif_zs': streamed(caseADIF_ADIF),
+    'fle_interp': caseFLE(False),
+    'fle_conv': caseFLE(True),
+    'wspr': caseWSPR,
+}
+
+
+def isFiles(res):
+    # writeZIP に渡す {ファイル名: 内容} 形式か
+    return (isinstance(res, dict) and
+            all(isinstance(v, (str, bytes)) for v in res.values()))
+
+
+def outputSize(res):
+    if isFiles(res):
+        return sum(len(v) for v in res.values())
+    if isinstance(res, io.BytesIO):
+        return len(res.getvalue())
+    if isinstance(res, dict):
+        return len(json.dumps(res))
+    return len(res)
+
+
+def maxRSS():
+    r = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux は KB、macOS は byte
+    return r // 1024 if sys.platform == 'darwin' else r
+
+
+def runOne(name, n, repeat):
+    import api.convutil as cu
+    cu.getPOTALoc = stubPOTALoc
+    cu.fetchPOTALoc = stubPOTALoc
+
+    run = cases[name](cu, n)
+    base_rss = maxRSS()
+    best = None
+    for _ in range(repeat):
+        t = time.perf_counter()
+        res = run()
+        e = time.perf_counter() - t
+        best = e if best is None else min(best, e)
+
+    r = {
+        'case': name,
+        'rows': n,
+        'seconds': round(best, 6),
+        'rows_per_sec': round(n / best, 1),
+        'output_bytes': outputSize(res),
+    }
+    if isFiles(res):
+        t = time.perf_counter()
+        zip_data = cu.writeZIP(res)
+        r['zip_seconds'] = round(time.perf_counter() - t, 6)
+        r['zip_bytes'] = len(zip_data)
+    r['base_rss_kb'] = base_rss
+    r['peak_rss_kb'] = maxRSS()
+    return r
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('-s', '--sizes', default='1000,10000,100000')
+    ap.add_argument('-c', '--cases', default=','.join(cases))
+    ap.add_argument('-r', '--repeat', type=int, default=3)
+    ap.add_argument('-o', '--output', default='bench_output.json')
+    ap.add_argument('--one', nargs=2, metavar=('CASE', 'ROWS'),
+                    help=argparse.SUPPRESS)
+    args = ap.parse_args()
+
+    if args.one:
+        (name, n) = args.one
+        print(json.dumps(runOne(name, int(n), args.repeat)))
+        return
+
+    results = []
+    for n in [int(s) for s in args.sizes.split(',')]:
+        for name in args.cases.split(','):
+            p = subprocess.run(
+                [sys.executable, '-m', 'benchmarks.suite',
+                 '-r', str(args.repeat), '--one', name, str(n)],
+                capture_output=True, text=True)
+            if p.returncode != 0:
+                r = {'case': name, 'rows': n, 'error': p.stderr.strip()[-2000:]}
+                print(f'{name:12} {n:>7} ERROR')
+            else:
+                r = json.loads(p.stdout.strip().splitlines()[-1])
+                print(f"{name:12} {n:>7} {r['seconds']*1000:10.1f}ms "
+                      f"{r['rows_per_sec']:>12,.0f} rows/s "
+                      f"{r['peak_rss_kb']/1024:8.1f}MB")
+            results.append(r)
+
+    report = {
+        'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'repeat': args.repeat,
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=1)
+
+
+if __name__ == '__main__':
+    main()
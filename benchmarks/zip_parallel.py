@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# coding: utf-8
+# writeZIP の並列圧縮: zipfile で逐次に作ったアーカイブとのバイト一致と速度
+#   python -m benchmarks.zip_parallel [行数]
+import io
+import os
+import sys
+import time
+import zipfile
+
+import api.convutil as cu
+from benchmarks import gen, suite
+
+date_time = (2024, 5, 1, 12, 34, 56)
+
+
+def refZIP(files, level, store=()):
+    # 同じ圧縮レベル・日時で zipfile が逐次に作るアーカイブ
+    buff = io.BytesIO()
+    with zipfile.ZipFile(buff, 'w', zipfile.ZIP_DEFLATED) as z:
+        for (k, v) in files.items():
+            data = v.encode('utf-8') if isinstance(v, str) else v
+            zinfo = zipfile.ZipInfo(k, date_time)
+            zinfo.external_attr = 0o600 << 16
+            if level == 0 or k in store or len(data) <= cu.ZIP_STORE_MAX:
+                z.writestr(zinfo, data, compress_type=zipfile.ZIP_STORED)
+            else:
+                z.writestr(zinfo, data, compress_type=zipfile.ZIP_DEFLATED,
+                           compresslevel=level)
+    return buff.getvalue()
+
+
+def best(f, repeat=3):
+    r = None
+    for _ in range(repeat):
+        t = time.perf_counter()
+        f()
+        e = time.perf_counter() - t
+        r = e if r is None else min(r, e)
+    return r
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    cu.getPOTALoc = cu.fetchPOTALoc = suite.stubPOTALoc
+    data = gen.hamlogCSV(n).encode('cp932')
+    import api.fleonline as fle
+    sets = {
+        'sota_a': cu.sendSOTA_A(io.BytesIO(data), cu.decodeHamlog, 'JL1NIE/1',
+                                suite.options(SOTAActivator='JL1NIE/1'),
+                                'cp932', 'utf-8'),
+        'adif': cu.sendADIF(io.BytesIO(data), suite.options(POTAActivator='JL1NIE/1'),
+                            'cp932', 'utf-8')[0],
+        'fle': {'fle-ユーザー.txt': gen.fleLog(n // 10), 'tiny.txt': 'x',
+                'empty.csv': ''},
+    }
+    bad = 0
+    for (name, files) in sets.items():
+        total = sum(len(v) for v in files.values())
+        for level in (0, 1, 6, 9):
+            ref = refZIP(files, level)
+            seq = cu.writeZIP(files, level, workers=1, date_time=date_time)
+            par = cu.writeZIP(files, level, workers=4, date_time=date_time)
+            ok = (ref == seq == par)
+            bad += not ok
+            print(f'{name:7} level {level}: {len(files):4} members '
+                  f'{total:>10} bytes -> {len(par):>9} '
+                  f"{'identical' if ok else 'MISMATCH'}")
+        level = cu.zipLevel(total)
+        ts = best(lambda: cu.writeZIP(files, level, workers=1))
+        tp = best(lambda: cu.writeZIP(files, level, workers=4))
+        print(f'{name:7} level {level}: sequential {ts*1000:.1f}ms, '
+              f'4 threads {tp*1000:.1f}ms (cpu {os.cpu_count()})')
+    sys.exit(1 if bad else 0)